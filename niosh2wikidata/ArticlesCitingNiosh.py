@@ -8,6 +8,27 @@ except ImportError:
     raise ImportError('Did you remember to `git submodule init` '
                       'and `git submodule update`?')
 
+# Citing articles handed to item_creator at once.
+CREATE_BATCH = 100
+
+
+def create_items(pmcids):
+    """
+    Creates Wikidata items for articles known only by their PMCIDs.
+
+    @param pmcids: list of PMCID strings, without the "PMC" prefix
+    """
+
+    if len(pmcids) == 0:
+        return
+
+    JournalArticles.item_creator([{
+        'doi': None,
+        'pmcid': pmcid,
+        'pmid': None,
+        'data': []
+    } for pmcid in pmcids])
+
 
 def main():
     seed = ('https://query.wikidata.org/sparql'
@@ -31,29 +52,26 @@ def main():
 
     pmcid_blob = pmcid_blob['results']['bindings']
 
-    # Two lists: one of all the PMCIDs on Wikidata, and one of just those that
+    # Two sets: one of all the PMCIDs on Wikidata, and one of just those that
     # are from NIOSH.
-    # The purpose of the first list is to see if we need to create a Wikidata
+    # The purpose of the first set is to see if we need to create a Wikidata
     # entry.
     # The purpose of the second is to actually send through Eutils – we are only
     # interested in a subset.
 
-    total_pmcid_list = []
-    niosh_pmcid_list = []
+    total_pmcid_set = set()
+    niosh_pmcid_set = set()
 
     for result in pmcid_blob:
-        total_pmcid_list.append(result['pmcid']['value'])
+        total_pmcid_set.add(result['pmcid']['value'])
         if 'nioshtic' in result:
-            niosh_pmcid_list.append(result['pmcid']['value'])
-
-    # Removing duplicates
-    total_pmcid_list = list(set(total_pmcid_list))
-    niosh_pmcid_list = list(set(niosh_pmcid_list))
+            niosh_pmcid_set.add(result['pmcid']['value'])
 
-    niosh_pmcid_list.sort(reverse=True)
+    niosh_pmcid_list = sorted(niosh_pmcid_set, reverse=True)
     packages = [niosh_pmcid_list[x:x+200] \
                 for x in range(0, len(niosh_pmcid_list), 200)]
-    nonexistent = []
+    nonexistent = set()
+    to_create = []
 
     for package in packages:
         query_string = ''
@@ -66,19 +84,17 @@ def main():
         for result in blob['linksets']:
             if 'linksetdbs' in result:
                 for citing_id in result['linksetdbs'][0]['links']:
-                    if str(citing_id) not in total_pmcid_list:
-                        if str(citing_id) not in nonexistent:
-                            nonexistent.append(str(citing_id))
-
-                            JournalArticles.item_creator([{
-                                'doi':
-                                None,
-                                'pmcid':
-                                str(citing_id),
-                                'pmid':
-                                None,
-                                'data': []
-                            }])
+                    citing_id = str(citing_id)
+                    if citing_id not in total_pmcid_set \
+                    and citing_id not in nonexistent:
+                        nonexistent.add(citing_id)
+                        to_create.append(citing_id)
+
+                        if len(to_create) >= CREATE_BATCH:
+                            create_items(to_create)
+                            to_create = []
+
+    create_items(to_create)
 
 
 if __name__ == '__main__':
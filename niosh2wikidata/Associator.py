@@ -4,38 +4,68 @@ Takes JSON output from Cleaner and associates it with other identifiers for
 cross-referencing.
 """
 
+import arrow
+import identifier_index
 import json
 import os
+import raw_manifest
+import records
 import requests
+import shutil
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+MAPPING_CACHE = 'cache/nioshtic_wikidata_mapping.json'
+MAPPING_PARTS = 'cache/nioshtic_wikidata_mapping_parts'
+default_mapping_ttl = 24 * 60 * 60  # seconds
 
-def get_nioshtic_wikidata_mapping():
+QUERY_TIMEOUT = 70  # WDQS itself gives up after 60 seconds
+default_retries = 4
+
+# The mapping for the current run, once fetched or loaded.
+_mapping = None
+
+
+def mapping_query(suffix=''):
     """
-    Retrieves a mapping between NIOSHTIC and Wikidata identifiers from the
-    Wikidata Query Service, query.wikidata.org
+    Builds the SPARQL query for one partition of the mapping. Items are
+    partitioned by the trailing digits of their Q-number, which spreads them
+    evenly without knowing anything about the data.
 
-    @return dictionary {nioshtic: {identifier_label: value}}
+    @param suffix: string of digits the Q-number must end with; '' for all
+    @return query URL
     """
 
-    prefix = 'http://www.wikidata.org/entity/'
-    q = (
-        'select%20%3Fi%20%3Fn%20%3Fdoi%20%3Fpubmed%20%3Fpmcid%20%3Fisbn10%20'
-        '%3Fisbn13%20where%20%7B%3Fi%20wdt%3AP2880%20%3Fn%20.%20optional%20%7B'
-        '%20%3Fi%20wdt%3AP356%20%3Fdoi%20%7D%20.%20optional%20%7B%20%3Fi%20wdt'
-        '%3AP698%20%3Fpubmed%20%7D%20.%20optional%20%7B%20%3Fi%20wdt%3AP932%20'
-        '%3Fpmcid%20%7D%20.%20optional%20%7B%20%3Fi%20wdt%3AP957%20%3Fisbn10'
-        '%20%7D%20.%20optional%20%7B%20%3Fi%20wdt%3AP212%20%3Fisbn13%20%7D%20'
-        '%7D')
-    url = 'https://query.wikidata.org/sparql?format=json&query=' + q
+    q = ('select ?i ?n ?doi ?pubmed ?pmcid ?isbn10 ?isbn13 where {'
+         '?i wdt:P2880 ?n . '
+         'optional { ?i wdt:P356 ?doi } . '
+         'optional { ?i wdt:P698 ?pubmed } . '
+         'optional { ?i wdt:P932 ?pmcid } . '
+         'optional { ?i wdt:P957 ?isbn10 } . '
+         'optional { ?i wdt:P212 ?isbn13 } . ')
 
-    try:
-        query = requests.get(url).json()['results']['bindings']
-    except:
-        raise Exception("Wikidata query not possible. Try again later.")
+    if suffix != '':
+        q += 'filter(strends(str(?i), "' + suffix + '")) '
 
-    data = {}
+    q += '}'
+
+    return ('https://query.wikidata.org/sparql?format=json&query=' +
+            urllib.parse.quote(q))
+
+
+def add_bindings(data, bindings):
+    """
+    Adds SPARQL results to a mapping dictionary.
 
-    for x in query:
+    @param data: dictionary {nioshtic: {identifier_label: value}}
+    @param bindings: list of SPARQL result bindings from mapping_query
+    """
+
+    prefix = 'http://www.wikidata.org/entity/'
+
+    for x in bindings:
         key = x['n']['value']
         data[key] = {'Wikidata': x['i']['value'].replace(prefix, '')}
 
@@ -54,10 +84,204 @@ def get_nioshtic_wikidata_mapping():
         if 'isbn13' in x:
             data[key]['ISBN-13'] = x['isbn13']['value']
 
+
+def fetch_partition(session, suffix, retries=default_retries):
+    """
+    Runs the query for one partition, retrying with backoff. A finished
+    partition is saved under MAPPING_PARTS so that a later attempt does not
+    have to fetch it again.
+
+    @param session: requests.Session
+    @param suffix: partition, as for mapping_query
+    @param retries: number of attempts before giving up
+    @return list of SPARQL result bindings
+    """
+
+    part_filename = os.path.join(MAPPING_PARTS, suffix + '.json')
+
+    if os.path.exists(part_filename):
+        age = time.time() - os.path.getmtime(part_filename)
+        if age < default_mapping_ttl:
+            with open(part_filename) as f:
+                return json.load(f)
+
+    for attempt in range(retries):
+        try:
+            r = session.get(mapping_query(suffix), timeout=QUERY_TIMEOUT)
+            r.raise_for_status()
+            bindings = r.json()['results']['bindings']
+            break
+        except Exception as e:
+            if attempt == retries - 1:
+                raise
+            print('Partition ' + suffix + ' failed (' + str(e) +
+                  '); retrying')
+            time.sleep(2 ** attempt)
+
+    os.makedirs(MAPPING_PARTS, exist_ok=True)
+    with open(part_filename + '.tmp', 'w') as f:
+        json.dump(bindings, f)
+    os.replace(part_filename + '.tmp', part_filename)
+
+    return bindings
+
+
+def get_nioshtic_wikidata_mapping(partition_digits=1, workers=4):
+    """
+    Retrieves a mapping between NIOSHTIC and Wikidata identifiers from the
+    Wikidata Query Service, query.wikidata.org
+
+    The query is split into 10 ** partition_digits partitions that are
+    fetched concurrently and retried individually. If some partitions still
+    fail, the ones that succeeded are kept on disk for the next attempt.
+
+    @param partition_digits: number of trailing Q-number digits to partition
+    on; 0 runs one unpartitioned query
+    @param workers: number of partitions to fetch at the same time
+    @return dictionary {nioshtic: {identifier_label: value}}
+    """
+
+    if partition_digits > 0:
+        suffixes = [str(x).zfill(partition_digits)
+                    for x in range(10 ** partition_digits)]
+    else:
+        suffixes = ['']
+
+    session = requests.Session()
+    data = {}
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_partition, session, x): x
+                   for x in suffixes}
+        for future in as_completed(futures):
+            try:
+                add_bindings(data, future.result())
+            except Exception:
+                failed.append(futures[future])
+
+    if len(failed) > 0:
+        raise Exception("Wikidata query not possible for partitions " +
+                        ', '.join(sorted(failed)) + ". Try again later.")
+
+    shutil.rmtree(MAPPING_PARTS, ignore_errors=True)
+
+    return data
+
+
+def get_index_mapping(index):
+    """
+    Builds the same mapping as get_nioshtic_wikidata_mapping from a local
+    identifier index, without touching the network.
+
+    @param index: an identifier_index.IdentifierIndex
+    @return dictionary {nioshtic: {identifier_label: value}}
+    """
+
+    labels = {
+        'P356': 'DOI',
+        'P698': 'PubMed ID',
+        'P932': 'PMCID',
+        'P957': 'ISBN-10',
+        'P212': 'ISBN-13'
+    }
+
+    data = {}
+
+    for nioshtic, qid in index.items_with('P2880'):
+        data[nioshtic] = {'Wikidata': qid}
+        for prop, values in index.identifiers_of(qid).items():
+            if prop in labels:
+                data[nioshtic][labels[prop]] = values[-1]
+
     return data
 
 
-def add_wikidata(nioshtic_data):
+def load_cached_mapping():
+    """
+    Reads the mapping saved by save_cached_mapping.
+
+    @return tuple of the mapping and the arrow time it was fetched, or
+    (None, None) if there is no usable cache file
+    """
+
+    if not os.path.exists(MAPPING_CACHE):
+        return None, None
+
+    try:
+        with open(MAPPING_CACHE) as f:
+            cached = json.load(f)
+        return cached['mapping'], arrow.get(cached['fetched'])
+    except (ValueError, KeyError):
+        return None, None
+
+
+def save_cached_mapping(mapping):
+    """
+    Atomically saves the mapping to MAPPING_CACHE with a freshness stamp.
+
+    @param mapping: dictionary as returned by get_nioshtic_wikidata_mapping
+    """
+
+    os.makedirs(os.path.dirname(MAPPING_CACHE), exist_ok=True)
+
+    with open(MAPPING_CACHE + '.tmp', 'w') as f:
+        json.dump({'fetched': arrow.utcnow().isoformat(), 'mapping': mapping},
+                  f)
+    os.replace(MAPPING_CACHE + '.tmp', MAPPING_CACHE)
+
+
+def get_cached_mapping(ttl=default_mapping_ttl, refresh=False, offline=False):
+    """
+    Gets the NIOSHTIC to Wikidata mapping at most once per run. A copy saved
+    on disk is reused while it is younger than `ttl`; otherwise the query is
+    run again. If the query fails, a stale copy is used rather than nothing.
+
+    @param ttl: maximum age of the on-disk copy, in seconds
+    @param refresh: ignore any copy and query Wikidata again
+    @param offline: build the mapping from the local identifier index instead
+    @return dictionary {nioshtic: {identifier_label: value}}
+    """
+
+    global _mapping
+
+    if _mapping is not None and refresh is False:
+        return _mapping
+
+    if offline is True:
+        index = identifier_index.get_default_index()
+        if index is None:
+            raise Exception('No identifier index at ' +
+                            identifier_index.DEFAULT_PATH)
+        _mapping = get_index_mapping(index)
+        return _mapping
+
+    cached, fetched = load_cached_mapping()
+    age = None
+    if fetched is not None:
+        age = (arrow.utcnow() - fetched).total_seconds()
+
+    if cached is not None and refresh is False and age < ttl:
+        print('Using NIOSHTIC-Wikidata mapping from ' + fetched.isoformat())
+        _mapping = cached
+        return _mapping
+
+    try:
+        _mapping = get_nioshtic_wikidata_mapping()
+    except Exception:
+        if cached is None:
+            raise
+        print('Wikidata query failed; using stale mapping from ' +
+              fetched.isoformat())
+        _mapping = cached
+        return _mapping
+
+    save_cached_mapping(_mapping)
+
+    return _mapping
+
+
+def add_wikidata(nioshtic_data, n_to_wd=None):
     """
     Associates NIOSHTIC entries with equivalent Wikidata identifiers, or skips
     over if there is no Wikidata identifier.
@@ -69,59 +293,116 @@ def add_wikidata(nioshtic_data):
 
     This also checks for PubMed ID, PMCID, DOI, ISBN-10, and ISBN-13.
 
-    @param nioshtic_data dictionary with "entries" and "headers" keys
+    @param nioshtic_data dictionary with "entries" and "headers" keys; the
+    entries may be a list or a one-time iterator such as records.Reader
+    provides
+    @param n_to_wd: the mapping to use; defaults to get_cached_mapping()
     @return new, updated dictionary
     """
 
     if 'headers' not in nioshtic_data or 'entries' not in nioshtic_data:
         raise ValueError('Data dictionary must have headers and entries keys')
 
-    n_to_wd = get_nioshtic_wikidata_mapping()
-    c = 0
+    if n_to_wd is None:
+        n_to_wd = get_cached_mapping()
 
-    for entry in nioshtic_data['entries']:
-        if 'NN' not in entry:
-            continue
-        if entry['NN'] in n_to_wd.keys():
-            for header, val in n_to_wd[entry['NN']].items():
-                nioshtic_data['entries'][c][header] = val
+    entries = associate_entries(nioshtic_data['entries'], n_to_wd,
+                                nioshtic_data['headers'])
+
+    if isinstance(nioshtic_data['entries'], list):
+        entries = list(entries)
 
-                if header not in nioshtic_data['headers']:
-                    nioshtic_data['headers'].append(header)
-        c += 1
+    nioshtic_data['entries'] = entries
 
     return nioshtic_data
 
 
-def process_file(filename):
+def associate_entries(entries, n_to_wd, headers):
     """
-    Loads a JSON file, runs it through the associator methods, and replaces the
-    old file.
+    Generator doing the work of add_wikidata one entry at a time.
 
-    @param filename: name of file to process (e.g. output.txt.json)
-    @return new file (e.g. output.txt.json)
+    @param entries: iterable of entries
+    @param n_to_wd: mapping as returned by get_nioshtic_wikidata_mapping
+    @param headers: list of header names, extended in place as new
+    identifiers are added
+    @return generator of updated entries
     """
 
-    with open(filename, 'r+') as f:
-        nioshtic_data = json.load(f)
-        nioshtic_data = add_wikidata(nioshtic_data)
-        f.seek(0)
-        json.dump(nioshtic_data, f, indent=4)
-        f.truncate()
+    known_headers = set(headers)
+
+    for entry in entries:
+        if 'NN' in entry and entry['NN'] in n_to_wd:
+            for header, val in n_to_wd[entry['NN']].items():
+                entry[header] = val
+
+                if header not in known_headers:
+                    known_headers.add(header)
+                    headers.append(header)
 
-        print("Updated file saved to: " + filename)
+        yield entry
 
 
-def main():
+def process_file(filename, n_to_wd=None):
+    """
+    Streams a file of cleaned entries through the associator methods and
+    replaces the old file. Files in the older single-document JSON format are
+    replaced by a JSON Lines file.
+
+    @param filename: name of file to process (e.g. output.txt.jsonl)
+    @param n_to_wd: the mapping to use; defaults to get_cached_mapping()
+    @return new file (e.g. output.txt.jsonl)
+    """
+
+    new_filename = filename
+    if not filename.lower().endswith('.jsonl'):
+        new_filename = filename[:-len('.json')] + '.jsonl'
+
+    with records.Reader(filename) as reader:
+        nioshtic_data = add_wikidata(reader.data(), n_to_wd)
+        with records.Writer(new_filename, nioshtic_data['retrieved'],
+                            nioshtic_data['headers']) as writer:
+            for entry in nioshtic_data['entries']:
+                writer.write(entry)
+
+    if new_filename != filename:
+        os.remove(filename)
+
+    print("Updated file saved to: " + new_filename)
+
+    return new_filename
+
+
+def main(skip_unchanged=True, refresh_mapping=False, offline=False):
     """
     If this file is invoked from command line, autodiscover JSON blobs in the
     raw/ subdirectory and process them.
+
+    @param skip_unchanged: skip files whose content has not changed since this
+    stage last processed them, according to raw/.manifest
+    @param refresh_mapping: query Wikidata even if the cached mapping is
+    still fresh
+    @param offline: take the mapping from the local identifier index
     """
 
+    manifest = raw_manifest.load_manifest()
+    n_to_wd = None
+
     for filename in os.listdir('raw/'):
-        if filename.lower().endswith('.json'):
-            process_file('raw/' + filename)
+        if records.is_entries_file(filename):
+            filename = 'raw/' + filename
+            if skip_unchanged is True \
+            and raw_manifest.is_processed(manifest, filename, 'Associator'):
+                print("Unchanged, skipping: " + filename)
+                continue
+            if n_to_wd is None:
+                n_to_wd = get_cached_mapping(refresh=refresh_mapping,
+                                             offline=offline)
+            process_file(filename, n_to_wd)
+            raw_manifest.mark_processed(manifest, filename, 'Associator',
+                                        rewrote=True)
 
 
 if __name__ == '__main__':
-    main()
+    main(skip_unchanged='--all' not in sys.argv,
+         refresh_mapping='--refresh' in sys.argv,
+         offline='--offline' in sys.argv)
@@ -4,117 +4,312 @@ Takes raw output from NIOSHTIC and converts it into a format usable by the rest
 of the Niosh2Wikidata library.
 """
 
+import argparse
 import arrow
-import json
+import gzip
+import io
 import os
+import raw_manifest
 import re
+import records
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
-def fix_format(to_process):
+DIVIDER = "++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++"
+
+# Physical lines starting with this are wrapped continuations of the line
+# above.
+CONTINUATION = '    '
+
+MULTIPLE_SPACES = re.compile(r' {2,}')
+
+# Raw exports run to hundreds of MB; read and decode them in large blocks.
+READ_BUFFER = 1024 * 1024
+
+
+def finish_line(line):
     """
-    Fixes weird formatting in the NIOSHTIC output.
+    Tidies up an assembled logical line.
 
-    @param to_process: string representing the file being cleaned
-    @return more consistently formatted string
+    @param line: string
+    @return string with repeated spaces collapsed and ends stripped
     """
 
-    DIVIDER = "++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++"
+    return MULTIPLE_SPACES.sub(' ', line).strip(' \t\n\r')
+
+
+def iter_lines(raw_lines):
+    """
+    Fixes weird formatting in the NIOSHTIC output in a single pass: line
+    endings are normalized, wrapped continuation lines are joined onto the
+    line they belong to, blank lines are dropped, and only the record section
+    between the second and third dividers is kept.
+
+    @param raw_lines: iterable of strings, e.g. a file opened by open_raw
+    @return generator of cleaned up lines, usually "KEY: value"
+    """
+
+    section = 0
+    line = None  # logical line being assembled
+    after_blank = False
+
+    for raw in raw_lines:
+        raw = raw.rstrip('\r\n')
+
+        if DIVIDER in raw:
+            if section == 2:
+                break
+            section += 1
+            continue
+
+        if section != 2:
+            continue  # header stuff
 
-    cleaned_string = to_process
+        if raw == '':
+            after_blank = True
+            continue
 
-    # Fix weird newline and space issues
-    cleaned_string = re.sub(r'\n {4}', ' ', cleaned_string)
-    cleaned_string = re.sub(r'\n{2,}', '\n', cleaned_string)
-    cleaned_string = re.sub(r'\n^(?!.+: )', ' ', cleaned_string)
-    cleaned_string = re.sub(r' {2,}', ' ', cleaned_string)
+        if raw.startswith(CONTINUATION) and not after_blank:
+            line = (line or '') + ' ' + raw[4:]
+        else:
+            # A continuation after a blank line has lost its parent and
+            # stands on its own.
+            if raw.startswith(CONTINUATION):
+                raw = ' ' + raw[4:]
+            if line is not None:
+                yield finish_line(line)
+            line = raw
 
-    # Get rid of header stuff
-    cleaned_string = cleaned_string.split(DIVIDER)[2]
+        after_blank = False
 
-    return cleaned_string
+    if line is not None:
+        yield finish_line(line)
 
 
-def clean(to_process):
+def fix_format(to_process):
     """
-    Takes raw output from NIOSHTIC and produces a cleaned up dictionary.
+    Fixes weird formatting in the NIOSHTIC output.
 
-    @param to_process: the string representing the file being cleaned
-    @return dict of cleaned up content
+    @param to_process: string representing the file being cleaned
+    @return more consistently formatted string
     """
 
-    cleaned_string = fix_format(to_process)
+    return '\n'.join(iter_lines(io.StringIO(to_process, newline='')))
+
 
-    headers = []  # list of strings
-    entries = []  # list of dictionaries
-    entry_counter = -1
+def iter_entries(raw_lines, headers=None, schema=None):
+    """
+    Parses raw NIOSHTIC output one record at a time.
+
+    @param raw_lines: iterable of strings, e.g. an open file
+    @param headers: optional dictionary used as an ordered set; field names
+    are added to it as they are first seen
+    @param schema: optional records.Schema; if given, entries are yielded as
+    records.CompactEntry objects sharing it instead of dictionaries
+    @return generator of entries
+    """
 
-    lines = cleaned_string.split('\n')
+    entry = None
 
-    for line in lines:
-        line = line.strip(' \t\n\r')
+    for line in iter_lines(raw_lines):
         if line == '':
             continue
         pair = line.split(':', 1)  # "NN: 123456"
         if len(pair) != 2:
             continue
-        rowkey = pair[0].strip()
+        rowkey = sys.intern(pair[0].strip())
         rowvalue = pair[1].strip()
         if rowvalue == '':
             continue
-        elif rowvalue[0] == ' ':
-            rowvalue = rowvalue[1:]  # truncating leading space
-        if rowkey == 'NN':  # NN delineates new entries
-            entry_counter += 1
-            entries.append({})
 
-        if rowkey not in headers:
-            headers.append(rowkey)
+        if rowkey == 'NN':  # NN delineates new entries
+            if entry is not None:
+                yield entry
+            entry = {} if schema is None else records.CompactEntry(schema)
+        elif entry is None:
+            continue  # nothing to attach this to yet
 
-        entries[entry_counter][rowkey] = rowvalue
+        if headers is not None and rowkey not in headers:
+            headers[rowkey] = None
 
         if rowkey == 'DT':
-            new_dt = entries[entry_counter][rowkey].split(';')
-            new_dt = [x.lower().strip() for x in new_dt]
-            entries[entry_counter]['DT'] = new_dt
+            entry['DT'] = [x.lower().strip() for x in rowvalue.split(';')]
+        else:
+            entry[rowkey] = rowvalue
+
+    if entry is not None:
+        yield entry
+
+
+def clean(to_process, compact=False):
+    """
+    Takes raw output from NIOSHTIC and produces a cleaned up dictionary.
+
+    @param to_process: the string representing the file being cleaned, or an
+    iterable of its lines
+    @param compact: hold entries as records.CompactEntry objects
+    @return dict of cleaned up content
+    """
+
+    if isinstance(to_process, str):
+        to_process = io.StringIO(to_process, newline='')
+
+    headers = {}  # ordered set of strings
+    schema = records.Schema() if compact is True else None
+    entries = list(iter_entries(to_process, headers, schema))
 
     retrieved = '+' + arrow.utcnow().format('YYYY-MM-DD') + 'T00:00:00Z'
-    return {'headers': headers, 'entries': entries, 'retrieved': retrieved}
+    return {'headers': list(headers), 'entries': entries,
+            'retrieved': retrieved}
+
+
+def open_raw(filename):
+    """
+    Opens a raw NIOSHTIC export for reading as text, transparently
+    decompressing .gz files written by `Downloader --gzip`.
+
+    The file is read and decoded in large blocks and iterated line by line.
+    Line endings are left alone (newline='') for iter_lines to deal with.
+
+    @param filename: path to a .txt or .txt.gz file
+    @return text file object
+    """
+
+    if filename.lower().endswith('.gz'):
+        raw = io.BufferedReader(gzip.open(filename, 'rb'), READ_BUFFER)
+    else:
+        raw = open(filename, 'rb', buffering=READ_BUFFER)
+
+    return io.TextIOWrapper(raw, encoding='ISO-8859-1', newline='')
+
+
+def output_filename(filename):
+    """
+    Names the JSON Lines file produced for a raw export. Compressed and plain
+    exports of the same range map to the same output.
+
+    @param filename: path to a .txt or .txt.gz file
+    @return string such as 'raw/2017-01_to_2017-12.txt.jsonl'
+    """
+
+    if filename.lower().endswith('.gz'):
+        filename = filename[:-3]
+
+    return filename + '.jsonl'
+
+
+def is_raw_file(filename):
+    """
+    Is this a raw NIOSHTIC export that the cleaner should pick up?
+
+    @return bool
+    """
+
+    return filename.lower().endswith(('.txt', '.txt.gz'))
 
 
 def process_file(filename):
     """
-    Loads a file, runs it through the clean method, and saves a new file.
+    Streams a file through the parser and saves the entries as JSON Lines,
+    one record at a time.
 
-    @param filename: name of file to process (e.g. output.txt)
-    @return new file (e.g. output.txt.json)
+    The output is written under a temporary name and renamed into place, so
+    an interrupted run never leaves a half-written file behind.
+
+    @param filename: name of file to process (e.g. output.txt or output.txt.gz)
+    @return tuple of the new file (e.g. output.txt.jsonl), the number of
+    entries in it, and the seconds taken
     """
 
-    new_content = {}
-    with open(filename, encoding='ISO-8859-1') as f:
-        blob = ''
-        for line in f:
-            blob += line
-        blob = blob.replace('\r\n', '\n')  # just in case
-        new_content = clean(blob)
+    started = time.perf_counter()
+
+    new_filename = output_filename(filename)
+    retrieved = '+' + arrow.utcnow().format('YYYY-MM-DD') + 'T00:00:00Z'
+
+    with open_raw(filename) as f, \
+         records.Writer(new_filename, retrieved) as writer:
+        for entry in iter_entries(f):
+            writer.write(entry)
 
-        new_filename = filename + '.json'
+    # Output from before the switch to JSON Lines would otherwise be picked up
+    # as a second copy of these entries.
+    legacy_filename = new_filename[:-1]
+    if os.path.exists(legacy_filename):
+        os.remove(legacy_filename)
 
-        with open(new_filename, 'w') as nf:
-            json.dump(new_content, nf, indent=4)
+    print("Processed file save to: " + new_filename)
 
-        print("Processed file save to: " + new_filename)
+    return (new_filename, writer.count, time.perf_counter() - started)
 
 
-def main():
+def print_summary(timings):
     """
-    If this file is invoked from command line, autodiscover textfiles in the
-    raw/ subdirectory and process them.
+    Prints how long each file took, slowest first.
+
+    @param timings: list of (filename, entry count, seconds) tuples
     """
 
+    if len(timings) == 0:
+        return
+
+    print('')
+    for filename, entries, seconds in sorted(timings, key=lambda x: -x[2]):
+        print('{0:8.2f}s {1:8d} entries  {2}'.format(seconds, entries,
+                                                    filename))
+    print('{0:8.2f}s {1:8d} entries  total of {2} files'.format(
+        sum(x[2] for x in timings), sum(x[1] for x in timings),
+        len(timings)))
+
+
+def main(skip_unchanged=True, jobs=1):
+    """
+    If this file is invoked from command line, autodiscover textfiles (plain
+    or gzipped) in the raw/ subdirectory and process them.
+
+    @param skip_unchanged: skip files whose content has not changed since they
+    were last cleaned, according to raw/.manifest
+    @param jobs: number of files to clean at the same time, each in its own
+    process
+    """
+
+    manifest = raw_manifest.load_manifest()
+    to_process = []
+
     for filename in os.listdir('raw/'):
-        if filename.lower().endswith('.txt'):
-            process_file('raw/' + filename)
+        if is_raw_file(filename):
+            filename = 'raw/' + filename
+            if skip_unchanged is True \
+            and raw_manifest.is_processed(manifest, filename, 'Cleaner') \
+            and os.path.exists(output_filename(filename)):
+                print("Unchanged, skipping: " + filename)
+                continue
+            to_process.append(filename)
+
+    timings = []
+
+    with ProcessPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {executor.submit(process_file, x): x for x in to_process}
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                timings.append(future.result())
+            except Exception as e:
+                print('Failed: ' + filename + ' (' + str(e) + ')')
+                continue
+            raw_manifest.mark_processed(manifest, filename, 'Cleaner',
+                                        rewrote=True)
+
+    print_summary(timings)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='files to clean in parallel processes')
+    parser.add_argument('--all', action='store_true',
+                        help='also clean files that have not changed')
+    args = parser.parse_args()
+
+    main(skip_unchanged=not args.all, jobs=args.jobs)
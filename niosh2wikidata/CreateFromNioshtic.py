@@ -14,9 +14,11 @@
 # Entries initially have: label, NIOSHTIC number, sponsored by: NIOSH,
 # title property
 
-import json
 import os
+import raw_manifest
+import records
 import re
+import sys
 from wikidataintegrator import wdi_core, wdi_login
 from wikidata_credentials import *
 
@@ -91,27 +93,39 @@ def process_data(nioshtic_data):
 
 def process_file(filename):
     """
-    Loads a JSON file and runs it through the item create/edit methods.
+    Streams a file of cleaned entries through the item create/edit methods.
 
-    @param filename: name of file to process (e.g. output.txt.json)
+    @param filename: name of file to process (e.g. output.txt.jsonl)
     """
 
-    with open(filename) as f:
-        nioshtic_data = json.load(f)
-        process_data(nioshtic_data)
+    with records.Reader(filename) as reader:
+        process_data(reader.data())
         print("Processed: " + filename)
 
 
-def main():
+def main(skip_unchanged=True):
     """
     If this file is invoked from command line, autodiscover JSON blobs in the
     raw/ subdirectory and process them.
+
+    @param skip_unchanged: skip files whose content has not changed since this
+    stage last processed them, according to raw/.manifest
     """
 
+    manifest = raw_manifest.load_manifest()
+
     for filename in os.listdir('raw/'):
-        if filename.lower().endswith('.json'):
-            process_file('raw/' + filename)
+        if records.is_entries_file(filename):
+            filename = 'raw/' + filename
+            if skip_unchanged is True \
+            and raw_manifest.is_processed(manifest, filename,
+                                          'CreateFromNioshtic'):
+                print("Unchanged, skipping: " + filename)
+                continue
+            process_file(filename)
+            raw_manifest.mark_processed(manifest, filename,
+                                        'CreateFromNioshtic')
 
 
 if __name__ == '__main__':
-    main()
+    main(skip_unchanged='--all' not in sys.argv)
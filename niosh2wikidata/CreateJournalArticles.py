@@ -8,9 +8,12 @@ entry and do it totally automatic.
 """
 
 import codeswitch
-import json
+import itertools
 import os
+import raw_manifest
+import records
 import requests
+import sys
 import URLtoIdentifier
 from wikidataintegrator import wdi_core, wdi_login
 from wikidata_credentials import *
@@ -23,6 +26,8 @@ except ImportError:
 
 WIKI_SESSION = wdi_login.WDLogin(user=wikidata_username, pwd=wikidata_password)
 
+PREFETCH_SIZE = 500
+
 
 def append_identifiers(wikidata_id,
                        doi=None,
@@ -69,6 +74,30 @@ def append_identifiers(wikidata_id,
     print(wikidata_id + '|' + doi + '|' + pmid + '|' + pmcid + '|' + nioshtic)
 
 
+def needs_processing(entry):
+    """
+    Is this an entry whose identifiers still need to be looked up?
+
+    @param entry: one NIOSHTIC entry
+    @return bool
+    """
+
+    if 'NN' not in entry:
+        return False
+
+    # If these values are populated, they were populated via the Wikidata
+    # item as identified via the NIOSHTIC ID, meaning the NIOSHTIC ID is
+    # already there and there is already an item filled out.
+    if 'DOI' in entry \
+    or 'PubMed ID' in entry \
+    or 'PMCID' in entry \
+    or 'Wikidata' in entry \
+    or 'LT' not in entry:
+        return False
+
+    return True
+
+
 def process_data(nioshtic_data):
     """
     The main method that kicks off the Wikidata editing. Takes a big bunch of
@@ -79,125 +108,166 @@ def process_data(nioshtic_data):
     to the appropriate databases. The integration of NIOSHTIC content itself is
     handled through a separate class.
 
+    Entries are handled PREFETCH_SIZE at a time: the links of a whole batch
+    are converted first, concurrently, then all of their identifiers are
+    resolved against codeswitch in one round trip. Entries whose link could
+    not be converted are skipped rather than treated as having no
+    identifiers.
+
     @param nioshtic_data: dictionary with "entries" and "headers" keys
+    @return number of entries skipped because their link failed to convert
     """
 
-    for entry in nioshtic_data['entries']:
-        if 'NN' not in entry:
-            continue
-
-        # If these values are populated, they were populated via the Wikidata
-        # item as identified via the NIOSHTIC ID, meaning the NIOSHTIC ID is
-        # already there and there is already an item filled out.
-        if 'DOI' in entry \
-        or 'PubMed ID' in entry \
-        or 'PMCID' in entry \
-        or 'Wikidata' in entry \
-        or 'LT' not in entry:
-            continue
-
-        wikidata_id = []
-
-        # The "interesting" factor: When the Wikidata item is known but has none
-        # of those other identifiers, yet Citoid turns out a result anyway.
-        # Meaning that the item is missing a non-NIOSHTIC identifier.
-        interesting = False
-        if 'Wikidata' in entry:
-            if 'DT' in entry:
-                if 'chapter' not in entry['DT'] and 'abstract' not in entry['DT']:
-                    wikidata_id.append(entry['Wikidata'])
-                    interesting = True
-            else:
-                wikidata_id.append(entry['Wikidata'])
-                interesting = True
+    entries = (x for x in nioshtic_data['entries'] if needs_processing(x))
+    failed = 0
+
+    while True:
+        batch = list(itertools.islice(entries, PREFETCH_SIZE))
+        if len(batch) == 0:
+            break
+
+        links = URLtoIdentifier.convert_many([x['LT'] for x in batch])
+        failed += sum(1 for x in batch if x['LT'] not in links)
+        batch = [x for x in batch if x['LT'] in links]
+
+        ident_blocks = [links[x['LT']] for x in batch]
+        resolved = codeswitch.prefetch(ident_blocks)
 
-        ident_block = URLtoIdentifier.convert(entry['LT'])
-        doi = ident_block['doi']  # string or None
-        pmid = ident_block['pmid']  # string or None
-        pmcid = ident_block['pmcid']  # string or None
+        for entry, ident_block in zip(batch, ident_blocks):
+            process_entry(entry, ident_block, resolved)
 
-        if doi is not None and codeswitch.doi_to_wikidata(doi) is not None:
-            wikidata_id.append(codeswitch.doi_to_wikidata(doi))
+    return failed
 
-        if pmid is not None and codeswitch.pmid_to_wikidata(pmid) is not None:
-            wikidata_id.append(codeswitch.pmid_to_wikidata(pmid))
 
-        if pmcid is not None and codeswitch.pmcid_to_wikidata(pmcid) is not None:
-            wikidata_id.append(codeswitch.pmcid_to_wikidata(pmcid))
+def process_entry(entry, ident_block, resolved):
+    """
+    Creates or updates the Wikidata item for one entry.
+
+    @param entry: one NIOSHTIC entry
+    @param ident_block: URLtoIdentifier.convert result for the entry's link
+    @param resolved: codeswitch.prefetch result covering ident_block
+    """
 
-        if interesting == True \
-        and (doi is not None or pmid is not None or pmcid is not None):
-            # wikidata_id must be defined as well
-            for single_wikidata_id in wikidata_id:
-                append_identifiers(
-                    single_wikidata_id, doi=doi, pmid=pmid, pmcid=pmcid)
+    wikidata_id = []
 
+    # The "interesting" factor: When the Wikidata item is known but has none
+    # of those other identifiers, yet Citoid turns out a result anyway.
+    # Meaning that the item is missing a non-NIOSHTIC identifier.
+    interesting = False
+    if 'Wikidata' in entry:
+        if 'DT' in entry:
+            if 'chapter' not in entry['DT'] and 'abstract' not in entry['DT']:
+                wikidata_id.append(entry['Wikidata'])
+                interesting = True
         else:
-            if wikidata_id == []:
-                # No Wikidata ID was found amongst the identifiers. This means
-                # the item truly does not exist, best we can tell.
-
-                if doi is not None or pmid is not None or pmcid is not None:
-                    add_data = [
-                        wdi_core.WDItemID(value='Q60346', prop_nr='P859')
-                    ]
-                    if 'DT' in entry:
-                        if 'abstract' in entry['DT'] or 'book' in entry['DT'] or 'chapter' in entry['DT']:
-                            add_data.append(
-                                wdi_core.WDString(
-                                    value=entry['NN'], prop_nr='P2880'))
-                    else:
+            wikidata_id.append(entry['Wikidata'])
+            interesting = True
+
+    doi = ident_block['doi']  # string or None
+    pmid = ident_block['pmid']  # string or None
+    pmcid = ident_block['pmcid']  # string or None
+
+    for id_name, id_value in [('doi', doi), ('pmid', pmid), ('pmcid', pmcid)]:
+        if id_value is not None:
+            found = resolved[id_name].get(id_value)
+            if found is not None:
+                wikidata_id.append(found)
+
+    if interesting == True \
+    and (doi is not None or pmid is not None or pmcid is not None):
+        # wikidata_id must be defined as well
+        for single_wikidata_id in wikidata_id:
+            append_identifiers(
+                single_wikidata_id, doi=doi, pmid=pmid, pmcid=pmcid)
+
+    else:
+        if wikidata_id == []:
+            # No Wikidata ID was found amongst the identifiers. This means
+            # the item truly does not exist, best we can tell.
+
+            if doi is not None or pmid is not None or pmcid is not None:
+                add_data = [
+                    wdi_core.WDItemID(value='Q60346', prop_nr='P859')
+                ]
+                if 'DT' in entry:
+                    if 'abstract' in entry['DT'] or 'book' in entry['DT'] or 'chapter' in entry['DT']:
                         add_data.append(
                             wdi_core.WDString(
                                 value=entry['NN'], prop_nr='P2880'))
-                    JournalArticles.item_creator([{
-                        'doi': doi,
-                        'pmcid': pmcid,
-                        'pmid': pmid,
-                        'data': add_data
-                    }])
-
-                    # If entry['DT'] is Abstract or Chapter, the item on that
-                    # thing will be created separately from its container.
-
-            else:
-                # Citoid found a DOI/PMID/PMCID that matched with an existing
-                # Wikidata entry, which means the Wikidata entry exists but just
-                # has no assigned NIOSHTIC-ID.
-                if 'DT' in entry:
-                    if 'journal article' in entry['DT'] or 'book' in entry['DT']:
-                        for single_wikidata_id in wikidata_id:
-                            append_identifiers(
-                                single_wikidata_id, nioshtic=entry['NN'])
                 else:
+                    add_data.append(
+                        wdi_core.WDString(
+                            value=entry['NN'], prop_nr='P2880'))
+                JournalArticles.item_creator([{
+                    'doi': doi,
+                    'pmcid': pmcid,
+                    'pmid': pmid,
+                    'data': add_data
+                }])
+
+                # If entry['DT'] is Abstract or Chapter, the item on that
+                # thing will be created separately from its container.
+
+        else:
+            # Citoid found a DOI/PMID/PMCID that matched with an existing
+            # Wikidata entry, which means the Wikidata entry exists but just
+            # has no assigned NIOSHTIC-ID.
+            if 'DT' in entry:
+                if 'journal article' in entry['DT'] or 'book' in entry['DT']:
                     for single_wikidata_id in wikidata_id:
                         append_identifiers(
                             single_wikidata_id, nioshtic=entry['NN'])
+            else:
+                for single_wikidata_id in wikidata_id:
+                    append_identifiers(
+                        single_wikidata_id, nioshtic=entry['NN'])
 
 
 def process_file(filename):
     """
-    Loads a JSON file and runs it through the item create/edit methods.
+    Streams a file of cleaned entries through the item create/edit methods.
 
-    @param filename: name of file to process (e.g. output.txt.json)
+    @param filename: name of file to process (e.g. output.txt.jsonl)
+    @return number of entries skipped because their link failed to convert
     """
 
-    with open(filename) as f:
-        nioshtic_data = json.load(f)
-        process_data(nioshtic_data)
+    with records.Reader(filename) as reader:
+        failed = process_data(reader.data())
         print("Processed: " + filename)
 
+    return failed
+
 
-def main():
+def main(skip_unchanged=True):
     """
     If this file is invoked from command line, autodiscover JSON blobs in the
     raw/ subdirectory and process them.
+
+    @param skip_unchanged: skip files whose content has not changed since this
+    stage last processed them, according to raw/.manifest
     """
 
+    manifest = raw_manifest.load_manifest()
+
     for filename in os.listdir('raw/'):
-        if filename.lower().endswith('.json'):
-            process_file('raw/' + filename)
+        if records.is_entries_file(filename):
+            filename = 'raw/' + filename
+            if skip_unchanged is True \
+            and raw_manifest.is_processed(manifest, filename,
+                                          'CreateJournalArticles'):
+                print("Unchanged, skipping: " + filename)
+                continue
+            failed = process_file(filename)
+            if failed > 0:
+                # Not marked as processed, so the next run tries again.
+                print(str(failed) + ' links could not be converted; '
+                      'run again to retry: ' + filename)
+                continue
+            raw_manifest.mark_processed(manifest, filename,
+                                        'CreateJournalArticles')
+
+    URLtoIdentifier.print_cache_stats()
 
 
 if __name__ == '__main__':
-    main()
+    main(skip_unchanged='--all' not in sys.argv)
@@ -5,10 +5,184 @@ Downloads records from NIOSHTIC and prepares text files.
 
 import requests
 import arrow
-import sys
+import argparse
+import gzip
+import hashlib
+import os
+import raw_manifest
+import threading
+import re
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 default_end_year = int(arrow.utcnow().format('YYYY')) + 1
 
+MANIFEST_LOCK = threading.Lock()
+
+CHUNK_SIZE = 1024 * 1024
+
+# NIOSHTIC will not return more than this many records for one search. A range
+# that comes back with this many is assumed to be truncated and is split.
+RECORD_LIMIT = 25000
+
+# When planning requests, consecutive years are merged while their expected
+# record count stays under this share of RECORD_LIMIT.
+FILL_TARGET = 0.8
+default_max_span = 10
+
+# In delta mode, ranges ending within this many years of now are always
+# refetched, and this share of the older ranges is rechecked on rotation.
+default_recent_years = 2
+default_sample = 0.1
+
+RECORD_START = re.compile(rb'^\s*NN:', re.MULTILINE)
+
+# A real export has its records between the second and third of these lines
+# (see Cleaner.DIVIDER). Error pages and failed sessions have none.
+EXPORT_DIVIDER = b'+' * 64
+MIN_DIVIDERS = 2
+
+# Maximum number of simultaneous requests to any one host. NIOSHTIC lives on a
+# single server, so this is the knob that actually keeps us polite.
+default_per_host = 4
+HOST_SLOTS = {}
+HOST_SLOTS_LOCK = threading.Lock()
+
+EXPORT_URL = ('https://www2a.cdc.gov/nioshtic-2/TICDownload.ASP'
+              '?submit1=Download'
+              '&RS1=0'
+              '&DownloadCount={0}'
+              '&DownloadStart=1'
+              '&select1=f'
+              '&recordset=0')
+
+
+def set_per_host_limit(limit):
+    """
+    Sets the number of requests allowed in flight to any single host.
+
+    @param limit: positive integer
+    """
+
+    with HOST_SLOTS_LOCK:
+        HOST_SLOTS.clear()
+        HOST_SLOTS[None] = limit
+
+
+def host_slot(url):
+    """
+    Returns the semaphore guarding requests to the host of a given URL.
+
+    @param url: string URL
+    @return threading.BoundedSemaphore
+    """
+
+    host = urllib.parse.urlsplit(url).netloc
+
+    with HOST_SLOTS_LOCK:
+        if host not in HOST_SLOTS:
+            limit = HOST_SLOTS.get(None, default_per_host)
+            HOST_SLOTS[host] = threading.BoundedSemaphore(limit)
+        return HOST_SLOTS[host]
+
+
+def fetch(session, url, **kwargs):
+    """
+    Performs a GET request while holding a slot for the target host.
+
+    @param session: requests.Session
+    @param url: string URL
+    @return requests.Response
+    """
+
+    with host_slot(url):
+        response = session.get(url, **kwargs)
+
+    response.raise_for_status()
+
+    return response
+
+def start_download(start_date, end_date, search_term=''):
+    """
+    Runs the NIOSHTIC search handshake that sets up an export.
+
+    @param start_date: month/year string in the style '01-2017'
+    @param end_date: month/year string in the style '12-2017'
+    @return requests.Session ready for open_download
+    """
+
+    session = requests.Session()
+
+    # Initialize session cookies
+    fetch(session, 'https://www2a.cdc.gov/nioshtic-2/advsearch2.asp')
+
+    # Execute search
+    fetch(session, 'https://www2a.cdc.gov/nioshtic-2/BuildQyr.asp'
+                   '?s1={0}'
+                   '&f1=TI'
+                   '&t1=0'
+                   '&s2='
+                   '&f2=TI'
+                   '&t2=0'
+                   '&s3='
+                   '&f3=TI'
+                   '&terms=3'
+                   '&Adv=1'
+                   '&n=new'
+                   '&View=b'
+                   '&Startyear={1}'
+                   '&EndYear={2}'
+                   '&whichdate=DP'
+                   '&D1=10'
+                   '&Limit={3}'
+                   '&Sort=DP+DESC'
+                   '&ct='
+                   '&B1=Search'.format(search_term, start_date, end_date,
+                                      RECORD_LIMIT))
+
+    # Trigger download
+    fetch(session, 'https://www2a.cdc.gov/nioshtic-2/Download.asp'
+                   '?s1={0}'
+                   '&f1=TI'
+                   '&Startyear={1}'
+                   '&terms=3'
+                   '&Adv=1'
+                   '&ct='
+                   '&Limit={3}'
+                   '&Sort=DP+DESC'
+                   '&whichdate=DP'
+                   '&D1=10'
+                   '&EndYear={2}'
+                   '&View=b'
+                   '&PageNo=1'
+                   '&RecordSet=0'.format(search_term, start_date, end_date,
+                                         RECORD_LIMIT))
+
+    return session
+
+
+def open_download(session):
+    """
+    Requests the export set up by start_download and returns the response
+    with its body not yet read, so callers can stream it.
+
+    Reading the body is the expensive part of a download, so this does not
+    take a host slot itself: hold host_slot(EXPORT_URL) from this call until
+    the body has been read.
+
+    @param session: requests.Session returned by start_download
+    @return streaming requests.Response for the NIOSHTIC output
+    """
+
+    response = session.get(EXPORT_URL.format(RECORD_LIMIT), stream=True)
+
+    if not response.ok:
+        response.close()
+        response.raise_for_status()
+
+    return response
+
+
 def get_content(start_date, end_date, search_term=''):
     """
 	Handles the primary work of downloading from NIOSHTIC and getting the raw
@@ -19,71 +193,57 @@ def get_content(start_date, end_date, search_term=''):
 	@return gigantic string containing the NIOSHTIC output
 	"""
 
-    session = requests.Session()
+    session = start_download(start_date, end_date, search_term)
 
-    # Initialize session cookies
-    session.get('https://www2a.cdc.gov/nioshtic-2/advsearch2.asp')
+    with host_slot(EXPORT_URL):
+        return open_download(session).text
 
-    # Execute search
-    session.get('https://www2a.cdc.gov/nioshtic-2/BuildQyr.asp'
-                '?s1={0}'
-                '&f1=TI'
-                '&t1=0'
-                '&s2='
-                '&f2=TI'
-                '&t2=0'
-                '&s3='
-                '&f3=TI'
-                '&terms=3'
-                '&Adv=1'
-                '&n=new'
-                '&View=b'
-                '&Startyear={1}'
-                '&EndYear={2}'
-                '&whichdate=DP'
-                '&D1=10'
-                '&Limit=25000'
-                '&Sort=DP+DESC'
-                '&ct='
-                '&B1=Search'.format(search_term, start_date, end_date))
 
-    # Trigger download
-    session.get('https://www2a.cdc.gov/nioshtic-2/Download.asp'
-                '?s1={0}'
-                '&f1=TI'
-                '&Startyear={1}'
-                '&terms=3'
-                '&Adv=1'
-                '&ct='
-                '&Limit=25000'
-                '&Sort=DP+DESC'
-                '&whichdate=DP'
-                '&D1=10'
-                '&EndYear={2}'
-                '&View=b'
-                '&PageNo=1'
-                '&RecordSet=0'.format(search_term, start_date, end_date))
-
-    # Carry out download
-    t = session.get('https://www2a.cdc.gov/nioshtic-2/TICDownload.ASP'
-                    '?submit1=Download'
-                    '&RS1=0'
-                    '&DownloadCount=25000'
-                    '&DownloadStart=1'
-                    '&select1=f'
-                    '&recordset=0')
-
-    return t.text
-
-
-def create_text_file(start_date, end_date, search_term=''):
-    """
-	Creates and saves a text file of the get_content output.
-
-	See the docstring for the get_content method for API information.
-	"""
+def stream_to_file(response, filename, compress=False):
+    """
+    Writes a response body to disk in chunks, never holding the whole export
+    in memory. The bytes are written exactly as NIOSHTIC sent them.
+
+    @param response: streaming requests.Response
+    @param filename: destination path
+    @param compress: gzip the output if True
+    @return tuple of the number of records (NN lines) received, the SHA-256
+    hex digest of the uncompressed body, and the number of divider lines
+    """
+
+    opener = gzip.open if compress is True else open
+    digest = hashlib.sha256()
+    records = 0
+    dividers = 0
+    tail = b''  # incomplete last line of the previous chunk
+
+    with opener(filename, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk:
+                f.write(chunk)
+                digest.update(chunk)
+                lines, _, tail = (tail + chunk).rpartition(b'\n')
+                records += len(RECORD_START.findall(lines))
+                if EXPORT_DIVIDER in lines:
+                    dividers += sum(1 for x in lines.split(b'\n')
+                                    if EXPORT_DIVIDER in x)
+
+    records += len(RECORD_START.findall(tail))
+    dividers += 1 if EXPORT_DIVIDER in tail else 0
+    response.close()
+
+    return records, digest.hexdigest(), dividers
 
-    to_write = get_content(start_date, end_date, search_term)
+
+def get_filename(start_date, end_date, compress=False):
+    """
+    Builds the raw/ filename for a date range.
+
+    @param start_date: month/year string in the style '01-2017'
+    @param end_date: month/year string in the style '12-2017'
+    @param compress: name the gzipped variant if True
+    @return string such as 'raw/2017-01_to_2017-12.txt'
+    """
 
     parts = [start_date.split('-'), end_date.split('-')]
 
@@ -91,34 +251,436 @@ def create_text_file(start_date, end_date, search_term=''):
                parts[0][1] + '-' + parts[0][0] + '_to_' + \
                parts[1][1] + '-' + parts[1][0] + '.txt'
 
-    with open(filename, 'w') as f:
-        f.write(to_write)
+    if compress is True:
+        filename += '.gz'
+
+    return filename
 
 
-def main(start_year=1900, end_year=default_end_year):
+def to_month_index(date):
     """
-	Create text files for January 1900 to this year + 1, or
-    the specified year range.
-	"""
+    Converts a month/year string into a count of months, so date ranges can be
+    compared and split arithmetically.
+
+    @param date: month/year string in the style '01-2017'
+    @return integer
+    """
+
+    month, year = date.split('-')
+
+    return int(year) * 12 + int(month) - 1
+
+
+def from_month_index(index):
+    """
+    Inverse of to_month_index.
+
+    @param index: integer
+    @return month/year string in the style '01-2017'
+    """
+
+    return '{0:02d}-{1}'.format(index % 12 + 1, index // 12)
+
+
+def range_months(date_range):
+    """
+    @param date_range: tuple of month/year strings
+    @return range of month indices covered, inclusive of both ends
+    """
+
+    return range(to_month_index(date_range[0]),
+                 to_month_index(date_range[1]) + 1)
+
+
+def year_range(first_year, last_year):
+    """
+    @return date range tuple covering January of first_year to December of
+    last_year
+    """
+
+    return ('01-' + str(first_year), '12-' + str(last_year))
+
+
+def split_range(date_range):
+    """
+    Splits a date range that hit RECORD_LIMIT into smaller ranges: several
+    years into two year-aligned halves, a year into half-years, and anything
+    smaller into single months.
+
+    @param date_range: tuple of month/year strings
+    @return list of date range tuples, or None if the range is a single month
+    """
+
+    months = range_months(date_range)
+
+    if len(months) == 1:
+        return None
+
+    if len(months) > 12 and len(months) % 12 == 0:
+        first_year = months[0] // 12
+        last_year = months[-1] // 12
+        middle = first_year + (last_year - first_year + 1) // 2
+        return [year_range(first_year, middle - 1),
+                year_range(middle, last_year)]
+
+    if len(months) == 12:
+        return [(from_month_index(months[0]), from_month_index(months[5])),
+                (from_month_index(months[6]), from_month_index(months[11]))]
+
+    return [(from_month_index(x), from_month_index(x)) for x in months]
+
+
+def mark_completed(manifest, start_date, end_date, records, sha256,
+                   compress=False):
+    """
+    Records a finished date range in the manifest and saves it. Entries for
+    other files overlapping the range are superseded, and their files removed
+    along with their cleaned JSON, so raw/ never holds the same record twice.
+
+    If the content hash matches the previous download of the same range, the
+    stage bookkeeping is kept so later stages can skip the file.
+
+    @param manifest: dictionary as returned by load_manifest
+    @param start_date: month/year string in the style '01-2017'
+    @param end_date: month/year string in the style '12-2017'
+    @param records: number of records downloaded
+    @param sha256: hex digest of the downloaded content
+    @param compress: whether the range was saved gzipped
+    @return True if the content differs from the previous download
+    """
+
+    filename = get_filename(start_date, end_date, compress)
+    plain_filename = get_filename(start_date, end_date)
+    keep = [plain_filename + '.jsonl', plain_filename + '.json']
+    months = set(range_months((start_date, end_date)))
+    now = arrow.utcnow().isoformat()
+
+    with MANIFEST_LOCK:
+        previous = raw_manifest.find_entry(manifest, plain_filename)
+        if previous is not None and \
+           (previous['start'], previous['end']) != (start_date, end_date):
+            previous = None
+
+        for key, entry in list(manifest.items()):
+            if key == filename:
+                continue
+            if months.isdisjoint(range_months((entry['start'],
+                                               entry['end']))):
+                continue
+            derived = get_filename(entry['start'], entry['end'])
+            for stale in [key, derived + '.jsonl', derived + '.json']:
+                if stale not in keep and os.path.exists(stale):
+                    os.remove(stale)
+            del manifest[key]
+
+        changed = previous is None or previous.get('sha256') != sha256
+
+        manifest[filename] = {
+            'start': start_date,
+            'end': end_date,
+            'records': records,
+            'truncated': records >= RECORD_LIMIT,
+            'sha256': sha256,
+            'completed': now,
+            'changed': now if changed else previous.get('changed', now),
+            'processed': {} if changed else previous.get('processed', {})
+        }
+        raw_manifest.save_manifest(manifest)
+
+    return changed
+
+
+def covered_years(manifest):
+    """
+    Finds the years whose every month is held by a downloaded file that was
+    not truncated. A single month that hit RECORD_LIMIT cannot be split any
+    further, so refetching it would only give the same truncated result; it
+    counts as held, the truncation having been warned about when it was
+    downloaded.
+
+    @param manifest: dictionary as returned by load_manifest
+    @return set of integer years
+    """
+
+    months = set()
+
+    for filename, entry in manifest.items():
+        if not os.path.exists(filename):
+            continue
+        if entry.get('truncated') is True \
+        and split_range((entry['start'], entry['end'])) is not None:
+            continue
+        months.update(range_months((entry['start'], entry['end'])))
+
+    return {x // 12 for x in months
+            if all(y in months for y in range((x // 12) * 12,
+                                              (x // 12) * 12 + 12))}
+
+
+def estimate_year_counts(manifest):
+    """
+    Estimates records per year from earlier runs. Ranges spanning several
+    years are spread evenly across them.
+
+    @param manifest: dictionary as returned by load_manifest
+    @return dictionary {year: estimated record count}
+    """
+
+    counts = {}
+
+    for entry in manifest.values():
+        if 'records' not in entry:
+            continue
+        months = range_months((entry['start'], entry['end']))
+        per_month = entry['records'] / len(months)
+        for month in months:
+            counts[month // 12] = counts.get(month // 12, 0) + per_month
+
+    return counts
+
+
+def plan_ranges(start_year, end_year, manifest, max_span=default_max_span,
+                resume=True):
+    """
+    Groups the requested years into as few date ranges as should fit under
+    RECORD_LIMIT. Years with record counts known from earlier runs are merged
+    while the total stays under FILL_TARGET; years with no history are grouped
+    up to max_span at a time and split later if they turn out to be full.
+
+    @param start_year: first year to download
+    @param end_year: last year to download
+    @param manifest: dictionary as returned by load_manifest
+    @param max_span: largest number of years to merge into one request
+    @param resume: leave out years already covered by the manifest
+    @return list of date range tuples
+    """
+
+    counts = estimate_year_counts(manifest)
+    skip = covered_years(manifest) if resume is True else set()
+    target = RECORD_LIMIT * FILL_TARGET
 
     date_ranges = []
+    group = []
+    total = 0
 
-    # Create a date range tuple for each year
     for y in range(start_year, end_year + 1):
-        tup = ('01-' + str(y), '12-' + str(y))
-        date_ranges.append(tup)
+        expected = counts.get(y, 0)
+
+        if y in skip or (len(group) > 0 and (len(group) >= max_span or
+                                             total + expected > target)):
+            if len(group) > 0:
+                date_ranges.append(year_range(group[0], group[-1]))
+            group = []
+            total = 0
+
+        if y in skip:
+            continue
+
+        group.append(y)
+        total += expected
 
-    for date_range in date_ranges:
-        print('Downloading: ' + date_range[0] + ' to ' + date_range[1])
-        create_text_file(date_range[0], date_range[1])
+    if len(group) > 0:
+        date_ranges.append(year_range(group[0], group[-1]))
+
+    return date_ranges
+
+
+def select_delta_ranges(manifest, start_year, end_year,
+                        recent_years=default_recent_years,
+                        sample=default_sample):
+    """
+    Picks the already-downloaded ranges worth fetching again in delta mode:
+    every range that reaches into the last `recent_years`, plus the share
+    `sample` of the older ones that were checked longest ago. Repeated runs
+    therefore rotate through the whole history.
+
+    @param manifest: dictionary as returned by load_manifest
+    @param start_year: first year of interest
+    @param end_year: last year of interest
+    @param recent_years: how many years back counts as recent
+    @param sample: fraction of older ranges to recheck, between 0 and 1
+    @return list of date range tuples
+    """
+
+    recent_cutoff = int(arrow.utcnow().format('YYYY')) - recent_years + 1
+    wanted = set(range(start_year * 12, end_year * 12 + 12))
+
+    recent = []
+    older = []
+
+    for filename, entry in manifest.items():
+        # Truncated or missing files are replanned by plan_ranges instead.
+        if entry.get('truncated') is True or not os.path.exists(filename):
+            continue
+        date_range = (entry['start'], entry['end'])
+        if wanted.isdisjoint(range_months(date_range)):
+            continue
+        if to_month_index(entry['end']) // 12 >= recent_cutoff:
+            recent.append(date_range)
+        else:
+            older.append((entry.get('completed', ''), date_range))
+
+    older.sort()
+    count = int(round(len(older) * sample))
+    if sample > 0 and len(older) > 0:
+        count = max(count, 1)
+
+    return sorted(recent) + [x[1] for x in older[:count]]
+
+
+def create_text_file(start_date, end_date, search_term='', compress=False):
+    """
+    Streams the NIOSHTIC output for a date range into a file under raw/.
+
+    See the docstring for the get_content method for API information.
+
+    @param compress: save as a gzipped .txt.gz file if True
+    @return tuple of the filename written, the number of records in it, and
+    the SHA-256 hex digest of its content
+    @raise requests.HTTPError: if NIOSHTIC answered with an error status
+    @raise ValueError: if the export has no record dividers, e.g. because the
+    session failed; nothing is saved
+    """
+
+    session = start_download(start_date, end_date, search_term)
+
+    filename = get_filename(start_date, end_date, compress)
+
+    # Write to a temporary name first so an interrupted run never leaves a
+    # truncated file that looks finished. The host slot covers the whole
+    # transfer, so --per-host limits concurrent exports, not just requests.
+    with host_slot(EXPORT_URL):
+        response = open_download(session)
+        records, sha256, dividers = stream_to_file(response,
+                                                   filename + '.part',
+                                                   compress)
+
+    if dividers < MIN_DIVIDERS:
+        os.remove(filename + '.part')
+        raise ValueError('not a NIOSHTIC export (no record dividers)')
+
+    os.replace(filename + '.part', filename)
+
+    return filename, records, sha256
+
+
+def download_range(manifest, date_range, compress=False):
+    """
+    Downloads one date range and records it in the manifest. If the range
+    came back full it is thrown away and the smaller ranges to fetch instead
+    are returned.
+
+    @param manifest: dictionary as returned by load_manifest
+    @param date_range: tuple of month/year strings
+    @param compress: save the range gzipped if True
+    @return list of date range tuples still to download
+    """
+
+    print('Downloading: ' + date_range[0] + ' to ' + date_range[1])
+    filename, records, sha256 = create_text_file(date_range[0], date_range[1],
+                                                 compress=compress)
+
+    if records >= RECORD_LIMIT:
+        smaller = split_range(date_range)
+        if smaller is not None:
+            print('Limit reached for ' + date_range[0] + ' to ' +
+                  date_range[1] + '; splitting into ' + str(len(smaller)))
+            os.remove(filename)
+            return smaller
+        print('Warning: ' + date_range[0] + ' has ' + str(records) +
+              ' records and cannot be split further; output is truncated')
+
+    changed = mark_completed(manifest, date_range[0], date_range[1], records,
+                             sha256, compress)
+    if changed is False:
+        print('Unchanged: ' + date_range[0] + ' to ' + date_range[1])
+
+    return []
+
+
+def main(start_year=1900, end_year=default_end_year, workers=1,
+         per_host=default_per_host, resume=True, compress=False,
+         max_span=default_max_span, delta=False,
+         recent_years=default_recent_years, sample=default_sample):
+    """
+    Create text files for January 1900 to this year + 1, or
+    the specified year range.
+
+    @param workers: number of date ranges to download at the same time
+    @param per_host: maximum simultaneous requests to the NIOSHTIC server
+    @param resume: skip date ranges already recorded in raw/.manifest
+    @param compress: save gzipped .txt.gz files instead of plain text
+    @param max_span: largest number of sparse years to merge into one request
+    @param delta: besides missing years, only refetch recent ranges and a
+    rotating sample of older ones
+    @param recent_years: in delta mode, years back that are always refetched
+    @param sample: in delta mode, fraction of older ranges rechecked per run
+    """
+
+    set_per_host_limit(per_host)
+
+    manifest = raw_manifest.load_manifest()
+
+    if delta is True:
+        resume = True
+
+    date_ranges = plan_ranges(start_year, end_year, manifest, max_span,
+                              resume)
+
+    if delta is True:
+        date_ranges += select_delta_ranges(manifest, start_year, end_year,
+                                           recent_years, sample)
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        pending = {executor.submit(download_range, manifest, x, compress): x
+                   for x in date_ranges}
+        while len(pending) > 0:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                date_range = pending.pop(future)
+                try:
+                    smaller = future.result()
+                except Exception as e:
+                    failures.append(date_range)
+                    print('Failed: ' + date_range[0] + ' to ' +
+                          date_range[1] + ' (' + str(e) + ')')
+                    continue
+                for x in smaller:
+                    pending[executor.submit(download_range, manifest, x,
+                                            compress)] = x
+
+    if len(failures) > 0:
+        print(str(len(failures)) + ' date ranges failed; run again to retry')
 
 
 if __name__ == '__main__':
-    args = [int(x) for x in sys.argv[1:]]
-
-    if len(args) == 0:
-        main()
-    elif len(args) == 1:
-        main(start_year=args[0])
-    elif len(args) == 2:
-        main(start_year=args[0], end_year=args[1])
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('start_year', nargs='?', type=int, default=1900)
+    parser.add_argument('end_year', nargs='?', type=int,
+                        default=default_end_year)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='date ranges to download concurrently')
+    parser.add_argument('--per-host', type=int, default=default_per_host,
+                        help='maximum simultaneous requests per host')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='ignore raw/.manifest and download everything')
+    parser.add_argument('--gzip', action='store_true',
+                        help='save raw exports as .txt.gz')
+    parser.add_argument('--max-span', type=int, default=default_max_span,
+                        help='most sparse years to merge into one request')
+    parser.add_argument('--delta', action='store_true',
+                        help='refetch only recent ranges and a rotating '
+                             'sample of older ones')
+    parser.add_argument('--recent-years', type=int,
+                        default=default_recent_years,
+                        help='years always refetched in delta mode')
+    parser.add_argument('--sample', type=float, default=default_sample,
+                        help='share of older ranges rechecked in delta mode')
+    args = parser.parse_args()
+
+    main(start_year=args.start_year, end_year=args.end_year,
+         workers=args.workers, per_host=args.per_host,
+         resume=not args.no_resume, compress=args.gzip,
+         max_span=args.max_span, delta=args.delta,
+         recent_years=args.recent_years, sample=args.sample)
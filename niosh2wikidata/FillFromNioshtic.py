@@ -1,8 +1,12 @@
 import arrow
-import json
+import identifier_index
+import itertools
 import os
+import raw_manifest
+import records
 import re
 import requests
+import sys
 import time
 import URLtoIdentifier
 from edit_queue import EditQueue
@@ -17,32 +21,45 @@ except ImportError:
 
 eq = EditQueue()
 
+PREFETCH_SIZE = 500
+
 WIKI_SESSION = wdi_login.WDLogin(user=wikidata_username, pwd=wikidata_password)
 
-isbn_map_raw = requests.get(
-    'https://query.wikidata.org/sparql?format=json&query=SELECT%20%3Fitem%20%3Fisbn13%20%3Fisbn10%20WHERE%20%7B%0A%7B%0A%20%20%20%20%3Fitem%20wdt%3AP212%20%3Fisbn13%20.%0A%7D%20UNION%20%7B%0A%20%20%20%20%3Fitem%20wdt%3AP957%20%3Fisbn10%20.%0A%7D%0A%7D'
-)
-isbn_map_raw = isbn_map_raw.json()['results']['bindings']
-isbn_map = {}
-
-for block in isbn_map_raw:
-    wd_item = block['item']['value'].replace('http://www.wikidata.org/entity/',
-                                             '')
-    if 'isbn13' in block:
-        res = block['isbn13']['value'].replace('-', '')
-    elif 'isbn10' in block:
-        res = block['isbn10']['value'].replace('-', '')
-    isbn_map[res] = wd_item
-
-cas_map = requests.get(
-    'https://query.wikidata.org/sparql?format=json&query=select%20%3Fi%20%3Fcas%20where%20%7B%20%3Fi%20wdt%3AP231%20%3Fcas%20%7D'
-)
-cas_map = cas_map.json()['results']['bindings']
-cas_map = {
-    x['cas']['value']:
-    x['i']['value'].replace('http://www.wikidata.org/entity/', '')
-    for x in cas_map
-}
+INDEX = identifier_index.get_default_index()
+
+# The local index stands in for a WDQS query only if it was built with the
+# properties in question.
+if INDEX is not None \
+and (INDEX.has_property('P212') or INDEX.has_property('P957')):
+    isbn_map = identifier_index.IndexMap(INDEX, ['P212', 'P957'])
+else:
+    isbn_map_raw = requests.get(
+        'https://query.wikidata.org/sparql?format=json&query=SELECT%20%3Fitem%20%3Fisbn13%20%3Fisbn10%20WHERE%20%7B%0A%7B%0A%20%20%20%20%3Fitem%20wdt%3AP212%20%3Fisbn13%20.%0A%7D%20UNION%20%7B%0A%20%20%20%20%3Fitem%20wdt%3AP957%20%3Fisbn10%20.%0A%7D%0A%7D'
+    )
+    isbn_map_raw = isbn_map_raw.json()['results']['bindings']
+    isbn_map = {}
+
+    for block in isbn_map_raw:
+        wd_item = block['item']['value'].replace(
+            'http://www.wikidata.org/entity/', '')
+        if 'isbn13' in block:
+            res = block['isbn13']['value'].replace('-', '')
+        elif 'isbn10' in block:
+            res = block['isbn10']['value'].replace('-', '')
+        isbn_map[res] = wd_item
+
+if INDEX is not None and INDEX.has_property('P231'):
+    cas_map = identifier_index.IndexMap(INDEX, ['P231'])
+else:
+    cas_map = requests.get(
+        'https://query.wikidata.org/sparql?format=json&query=select%20%3Fi%20%3Fcas%20where%20%7B%20%3Fi%20wdt%3AP231%20%3Fcas%20%7D'
+    )
+    cas_map = cas_map.json()['results']['bindings']
+    cas_map = {
+        x['cas']['value']:
+        x['i']['value'].replace('http://www.wikidata.org/entity/', '')
+        for x in cas_map
+    }
 
 
 def indirect_identifier(wd, id_name, id_value):
@@ -56,6 +73,16 @@ def indirect_identifier(wd, id_name, id_value):
     """
 
     id_entity = {'doi': 'P356', 'pmid': 'P698', 'pmcid': 'P932'}
+
+    # An index hit is trusted; a miss may only mean the index is stale or
+    # lacks the property, so it is confirmed with WDQS before an item is
+    # created.
+    if INDEX is not None:
+        found = INDEX.lookup(id_entity[id_name], id_value)
+        if len(found) > 0:
+            link_indirect(wd, id_value, found)
+            return
+
     lookup = 'select%20%3Fi%20where%20%7B%20%3Fi%20wdt%3A{0}%20%22{1}%22%20%7D'
     lookup = lookup.format(id_entity[id_name], id_value)
     lookup = 'https://query.wikidata.org/sparql?format=json&query=' + lookup
@@ -65,10 +92,24 @@ def indirect_identifier(wd, id_name, id_value):
         print(e)
         return
 
-    if len(lookup) > 0:
-        for result in lookup:
-            relevant_item = result['i']['value'].replace(
-                'http://www.wikidata.org/entity/', '')
+    link_indirect(wd, id_value, [
+        x['i']['value'].replace('http://www.wikidata.org/entity/', '')
+        for x in lookup
+    ])
+
+
+def link_indirect(wd, id_value, relevant_items):
+    """
+    Second half of `indirect_identifier`: links the items found, or creates
+    one if there were none.
+
+    @param wd: a WikidataEntry object
+    @param id_value: the identifier of the other work
+    @param relevant_items: list of Q-numbers having the identifier
+    """
+
+    if len(relevant_items) > 0:
+        for relevant_item in relevant_items:
             wd.append('itemid', 'P361', relevant_item)
     else:
         for new_item in JournalArticles.item_creator([{'doi': id_value}]):
@@ -564,6 +605,37 @@ class WikidataEntry:
             eq.post(self.wikidata_id, self.data, self.label, self.description)
 
 
+def prefetch_links(entries):
+    """
+    Converts the links of PREFETCH_SIZE entries at a time, concurrently,
+    ahead of the edits that need them.
+
+    Only links that can be read locally or are already cached are converted
+    here. Whether an item needs its link converted at all is only known once
+    its Wikidata entry is loaded, so Citoid is left to fill() to call for the
+    items that do. Links whose lookup failed here are missing too, and are
+    converted again, with errors raised, when fill() reaches them.
+
+    @param entries: iterable of NIOSHTIC entries
+    @return generator of (entry, {link: URLtoIdentifier.convert result}), in
+    which the dictionary lacks the links that would need Citoid or failed
+    """
+
+    entries = iter(entries)
+
+    while True:
+        batch = list(itertools.islice(entries, PREFETCH_SIZE))
+        if len(batch) == 0:
+            break
+
+        links = URLtoIdentifier.convert_many(
+            [x['LT'] for x in batch if 'Wikidata' in x and 'LT' in x],
+            use_citoid=False)
+
+        for entry in batch:
+            yield entry, links
+
+
 def fill(nioshtic_data):
     """
     Fill out several Wikidata items based on NIOSHTIC data
@@ -571,7 +643,7 @@ def fill(nioshtic_data):
     @param nioshtic_data: a dictionary with lots of NIOSHTIC data
     """
 
-    for entry in nioshtic_data['entries']:
+    for entry, links in prefetch_links(nioshtic_data['entries']):
         if 'Wikidata' in entry:
             wd = WikidataEntry(entry, nioshtic_data['retrieved'])
             '''
@@ -601,7 +673,9 @@ def fill(nioshtic_data):
             or wd.has_property('P932') is False:
 
                 if 'LT' in entry:
-                    identifiers = URLtoIdentifier.convert(entry['LT'])
+                    identifiers = links.get(entry['LT'])
+                    if identifiers is None:
+                        identifiers = URLtoIdentifier.convert(entry['LT'])
 
                     if identifiers['doi'] is not None \
                     and wd.has_property('P356') is False:
@@ -758,29 +832,43 @@ def fill(nioshtic_data):
 
 def process_file(filename):
     """
-    Loads a JSON file and runs it through the item create/edit methods.
+    Streams a file of cleaned entries through the item create/edit methods.
 
-    @param filename: name of file to process (e.g. output.txt.json)
+    @param filename: name of file to process (e.g. output.txt.jsonl)
     """
 
-    with open(filename) as f:
-        nioshtic_data = json.load(f)
-        fill(nioshtic_data)
+    with records.Reader(filename) as reader:
+        fill(reader.data())
         print("Processed: " + filename)
 
 
-def main():
+def main(skip_unchanged=True):
     """
     If this file is invoked from command line, autodiscover JSON blobs in the
     raw/ subdirectory and process them.
+
+    @param skip_unchanged: skip files whose content has not changed since this
+    stage last processed them, according to raw/.manifest
     """
 
+    manifest = raw_manifest.load_manifest()
+
     for filename in os.listdir('raw/'):
-        if filename.lower().endswith('.json'):
-            process_file('raw/' + filename)
+        if records.is_entries_file(filename):
+            filename = 'raw/' + filename
+            if skip_unchanged is True \
+            and raw_manifest.is_processed(manifest, filename,
+                                          'FillFromNioshtic'):
+                print("Unchanged, skipping: " + filename)
+                continue
+            process_file(filename)
+            raw_manifest.mark_processed(manifest, filename,
+                                        'FillFromNioshtic')
+
+    URLtoIdentifier.print_cache_stats()
 
     eq.done()
 
 
 if __name__ == '__main__':
-    main()
+    main(skip_unchanged='--all' not in sys.argv)
@@ -1,77 +1,362 @@
-import redis
+import argparse
+import crossref_snapshot
+import queue
+import rate_limit
+import redis_pool
 import requests
 import editdistance
+import sys
 import threading
+import time
 from datetime import timedelta
 
-REDIS = redis.Redis(host='127.0.0.1', port=6379)
+REDIS = redis_pool.client
+
+CROSSREF = "https://api.crossref.org/works"
+
+# A fixed number of workers share one HTTP session and one token bucket.
+# The bucket starts at CROSSREF_RATE requests per second and follows the
+# X-Rate-Limit-Limit / X-Rate-Limit-Interval headers Crossref sends back.
+WORKERS = 8
+CROSSREF_RATE = 10
+CROSSREF_TIMEOUT = (5, 30)
+RETRIES = 3
+
+MGET_BATCH = 10000
+
+# Results buffered by ResultSink between pipelined writes.
+SINK_BATCH = 500
+
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=WORKERS))
+LIMITER = rate_limit.TokenBucket(CROSSREF_RATE)
+
+
+def honor_rate_limit(response):
+    """
+    Adjusts LIMITER to the limits announced in a Crossref response, e.g.
+    "X-Rate-Limit-Limit: 50" with "X-Rate-Limit-Interval: 1s".
+
+    @param response: requests.Response from api.crossref.org
+    """
+
+    limit = response.headers.get('X-Rate-Limit-Limit')
+    interval = response.headers.get('X-Rate-Limit-Interval', '1s')
+
+    try:
+        limit = int(limit)
+        interval = float(interval.rstrip('s'))
+    except (TypeError, ValueError):
+        return
+
+    if limit > 0 and interval > 0:
+        LIMITER.set_rate(limit / interval, burst=limit)
+
+
+def ask_crossref(title):
+    """
+    Searches Crossref for works with a title.
+
+    @param title: string
+    @return list of Crossref work records, or None if the search failed
+    """
+
+    for attempt in range(RETRIES):
+        LIMITER.acquire()
+
+        try:
+            response = SESSION.get(CROSSREF, params={'query.title': title},
+                                   timeout=CROSSREF_TIMEOUT)
+        except requests.RequestException:
+            continue
+
+        honor_rate_limit(response)
+
+        if response.status_code == 429:
+            try:
+                wait = float(response.headers.get('Retry-After', 1))
+            except ValueError:
+                wait = 1
+            time.sleep(wait)
+            continue
+
+        # Anything but a proper answer is a failure, not an empty result, so
+        # the item is retried on a later run rather than marked as a miss.
+        if response.status_code != 200:
+            return None
+
+        try:
+            crossref_data = response.json()
+        except ValueError:
+            return None
+
+        if "message" in crossref_data:
+            if "items" in crossref_data["message"]:
+                return crossref_data["message"]["items"]
+
+        return []
+
+    return None
+
+
+def best_match(thing, crossref_data):
+    """
+    Picks the Crossref result that is the same article as a Wikidata item:
+    same volume and issue, and a title within 10 edits.
+
+    @param thing: SPARQL result binding with "title", "vol", and "issue"
+    @param crossref_data: list of Crossref work records
+    @return DOI string, upper-cased, or None
+    """
+
+    title = thing["title"]["value"]
+    volume = thing["vol"]["value"]
+    issue = thing["issue"]["value"]
+
+    for result in crossref_data:
+        if "volume" in result and "issue" in result and "title" in result:
+            if result["volume"] == volume:
+                if result["issue"] == issue:
+                    crossref_title = result["title"][0].upper()
+                    if editdistance.eval(
+                            title.upper(), crossref_title
+                    ) < 10:  # levenshtein distance
+                        return result["DOI"].upper()
+
+    return None
+
+
+class ResultSink:
+    def __init__(self, output=None, batch=SINK_BATCH):
+        """
+        Constructor of the ResultSink class, which collects results from all
+        worker threads and writes them out in batches: to Redis in one
+        pipeline, and as QuickStatements lines (item, P356, quoted DOI,
+        tab-separated) to a file or, failing that, to stdout.
+
+        @param output: path of the QuickStatements file to append to
+        @param batch: results buffered before a flush
+        """
+        self.lock = threading.Lock()
+        self.batch = batch
+        self.pending = []
+        self.counts = {'matched': 0, 'missed': 0, 'errored': 0}
+        self.output = None if output is None else open(output, 'a')
+
+    def add(self, wikidata_item, doi):
+        """
+        Records the outcome for one item: the DOI if one was found, otherwise
+        an empty marker so the item is not retried for 30 days.
+        """
+
+        with self.lock:
+            self.pending.append((wikidata_item, doi))
+            self.counts['missed' if doi is None else 'matched'] += 1
+            if len(self.pending) >= self.batch:
+                self.flush_locked()
+
+    def error(self, wikidata_item):
+        """
+        Counts an item whose lookup failed. Nothing is saved, so it is tried
+        again next run.
+        """
+
+        with self.lock:
+            self.counts['errored'] += 1
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if len(self.pending) == 0:
+            return
+
+        lines = []
+        pipe = REDIS.pipeline(transaction=False)
+        for wikidata_item, doi in self.pending:
+            if doi is not None:
+                lines.append(wikidata_item + "\tP356\t\"" + doi + "\"\n")
+                pipe.set('nioshtic_to_doi__' + wikidata_item, doi)
+            else:
+                pipe.setex('nioshtic_to_doi__' + wikidata_item,
+                           timedelta(days=30), '')
+        pipe.execute()
+
+        if self.output is not None:
+            self.output.writelines(lines)
+            self.output.flush()
+        else:
+            sys.stdout.writelines(lines)
+            sys.stdout.flush()
+
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+        if self.output is not None:
+            self.output.close()
+
+        print('{matched} matched, {missed} missed, {errored} errored'.format(
+            **self.counts), file=sys.stderr)
+
+
+def resolve(thing, sink):
+    """
+    Looks for the DOI of one Wikidata item on Crossref, by its title, and
+    records the outcome.
+
+    @param thing: SPARQL result binding with "item", "title", "vol", and
+    "issue"
+    @param sink: ResultSink
+    """
+
+    crossref_data = ask_crossref(thing["title"]["value"])
+    if crossref_data is None:
+        sink.error(item_id(thing))
+        return
+
+    sink.add(item_id(thing), best_match(thing, crossref_data))
+
+
+def resolve_offline(seed, snapshot_files, sink):
+    """
+    Matches the seed against local Crossref snapshots (see crossref_snapshot)
+    and records the DOIs found. Only the volumes and issues that occur in the
+    seed are indexed.
+
+    @param seed: list of SPARQL result bindings
+    @param snapshot_files: list of snapshot paths
+    @param sink: ResultSink
+    @return list of the bindings that found no match
+    """
+
+    wanted = {(x["vol"]["value"], x["issue"]["value"]) for x in seed}
+
+    snapshot = crossref_snapshot.Snapshot()
+    for filename in snapshot_files:
+        snapshot.load(filename, wanted)
+
+    unmatched = []
+    for thing in seed:
+        doi = snapshot.match(thing["title"]["value"], thing["vol"]["value"],
+                             thing["issue"]["value"])
+        if doi is None:
+            unmatched.append(thing)
+        else:
+            sink.add(item_id(thing), doi)
+
+    return unmatched
+
+
+def item_id(thing):
+    return thing["item"]["value"].replace("http://www.wikidata.org/entity/",
+                                          "")
+
+
+def unresolved(seed):
+    """
+    Drops the items that already have a result in Redis, found or recently
+    missed, checking MGET_BATCH keys per MGET in a single pipeline.
+
+    @param seed: list of SPARQL result bindings
+    @return list of the bindings still to be resolved
+    """
+
+    pipe = REDIS.pipeline(transaction=False)
+    for x in range(0, len(seed), MGET_BATCH):
+        pipe.mget(['nioshtic_to_doi__' + item_id(y)
+                   for y in seed[x:x + MGET_BATCH]])
+
+    known = [y for x in pipe.execute() for y in x]
+
+    return [x for x, y in zip(seed, known) if y is None]
 
 
 class AskCrossref(threading.Thread):
-    def __init__(self, threadID, name, package):
+    def __init__(self, threadID, name, work, sink):
+        """
+        Constructor of the AskCrossref class: a worker that resolves items
+        from a shared queue until it takes None off it.
+
+        @param threadID: integer
+        @param name: thread name
+        @param work: queue.Queue of SPARQL result bindings
+        @param sink: ResultSink shared by all workers
+        """
         threading.Thread.__init__(self)
         self.threadID = threadID
         self.name = name
-        self.package = package
+        self.work = work
+        self.sink = sink
 
     def run(self):
-        crossref = "https://api.crossref.org/works?query.title={0}"
-        for thing in self.package:
-            wikidata_item = thing["item"]["value"].replace(
-                "http://www.wikidata.org/entity/", "")
-            title = thing["title"]["value"]
-            volume = thing["vol"]["value"]
-            issue = thing["issue"]["value"]
-
+        while True:
+            thing = self.work.get()
+            if thing is None:
+                break
             try:
-                crossref_data = requests.get(crossref.format(title)).json()
-            except:
-                continue
-
-            found = False
-            if "message" in crossref_data:
-                if "items" in crossref_data["message"]:
-                    crossref_data = crossref_data["message"]["items"]
-
-                    for result in crossref_data:
-                        if "volume" in result and "issue" in result and "title" in result:
-                            if result["volume"] == volume:
-                                if result["issue"] == issue:
-                                    crossref_title = result["title"][0].upper()
-                                    if editdistance.eval(
-                                            title.upper(), crossref_title
-                                    ) < 10:  # levenshtein distance
-                                        found = True
-                                        doi = result["DOI"].upper()
-                                        print(wikidata_item + "\tP356\t\"" +
-                                              doi + "\"")
-                                        REDIS.set('nioshtic_to_doi__' +
-                                                  wikidata_item, doi)
-                                        break
-            if found is False:
-                REDIS.setex(
-                    'nioshtic_to_doi__' + wikidata_item,
-                    timedelta(days=30),
-                    '')
-
-
-def main():
+                resolve(thing, self.sink)
+            except Exception as e:
+                self.sink.error(item_id(thing))
+                print(self.name + ': ' + repr(e), file=sys.stderr)
+
+
+def main(snapshot_files=(), offline=False, output=None):
+    """
+    Finds DOIs for NIOSHTIC items on Wikidata that have a title, volume, and
+    issue but no DOI.
+
+    @param snapshot_files: local Crossref snapshots to match against first
+    @param offline: do not query the Crossref API for the items the
+    snapshots did not match
+    @param output: file to append QuickStatements to, instead of stdout
+    """
+
     seed = "https://query.wikidata.org/sparql?format=json&query=SELECT%20%3Fitem%20%3Ftitle%20%3Fvol%20%3Fissue%20WHERE%20%7B%0A%20%20%3Fitem%20wdt%3AP2880%20%3Fid%20.%0A%20%20%3Fitem%20wdt%3AP1476%20%3Ftitle%20.%0A%20%20%3Fitem%20wdt%3AP478%20%3Fvol%20.%0A%20%20%3Fitem%20wdt%3AP433%20%3Fissue%20.%0A%20%20OPTIONAL%20%7B%20%3Fitem%20wdt%3AP356%20%3Fdummy1%20%7D%0A%20%20FILTER%28%21bound%28%3Fdummy1%29%29%0A%7D%0Aorder%20by%20desc%28%3Fitem%29"
     seed = requests.get(seed).json()["results"]["bindings"]
-    seed = [
-        x for x in seed
-        if REDIS.get('nioshtic_to_doi__' + x["item"]["value"].replace(
-            "http://www.wikidata.org/entity/", "")) is None
-    ]
-
-    thread_counter = 0
-    packages = [seed[x:x + 200] for x in range(0, len(seed), 200)]
-    for package in packages:
+    seed = unresolved(seed)
+
+    sink = ResultSink(output)
+
+    if len(snapshot_files) > 0:
+        seed = resolve_offline(seed, snapshot_files, sink)
+        # Absent from a snapshot is not the same as absent from Crossref, so
+        # offline misses are not recorded.
+        if offline is True:
+            sink.close()
+            return
+
+    work = queue.Queue()
+    for thing in seed:
+        work.put(thing)
+
+    threads = []
+    for thread_counter in range(WORKERS):
+        work.put(None)
         thread = AskCrossref(thread_counter, "thread-" + str(thread_counter),
-                             package)
-        thread_counter += 1
+                             work, sink)
         thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    sink.close()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(
+        description='Find DOIs for NIOSHTIC items through Crossref.')
+    parser.add_argument('--snapshot', action='append', default=[],
+                        help='Crossref snapshot (JSON Lines) to match '
+                             'against before using the API; repeatable')
+    parser.add_argument('--offline', action='store_true',
+                        help='only match against the snapshots')
+    parser.add_argument('--output',
+                        help='append QuickStatements here instead of stdout')
+    args = parser.parse_args()
+
+    main(args.snapshot, args.offline, args.output)
@@ -1,10 +1,73 @@
+import json
+import rate_limit
+import re
+import threading
 import urllib.parse
 import requests
-import redis
+import redis_pool
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from wikidata_credentials import *
 
-REDIS = redis.Redis(host=redis_server, port=redis_port, password=redis_key)
+REDIS = redis_pool.client
+
+# Citoid answers are kept in Redis under CACHE_PREFIX + link. Links that
+# resolved to something are kept much longer than links that did not, which
+# are worth retrying now and then as Citoid improves.
+CACHE_PREFIX = 'nioshtic__'
+POSITIVE_TTL = timedelta(days=180)
+NEGATIVE_TTL = timedelta(days=7)
+
+STATS = {'local': 0, 'hits': 0, 'misses': 0, 'failed': 0}
+STATS_LOCK = threading.Lock()
+
+# Citoid requests share one session, are spaced out to CITOID_RATE per
+# second, and give up after CITOID_TIMEOUT (connect, read) seconds. Once
+# CITOID_FAILURES of them fail in a row, further lookups fail immediately
+# for CITOID_COOLDOWN seconds instead of queueing behind a degraded service.
+CITOID_RATE = 5
+CITOID_TIMEOUT = (5, 30)
+CITOID_FAILURES = 5
+CITOID_COOLDOWN = 60
+
+default_workers = 8
+
+SESSION = requests.Session()
+LIMITER = rate_limit.TokenBucket(CITOID_RATE)
+BREAKER = rate_limit.CircuitBreaker(CITOID_FAILURES, CITOID_COOLDOWN)
+
+# Link shapes that can be read without asking Citoid, as (identifier kind,
+# pattern). Each pattern puts the identifier in the group named {}. Earlier
+# entries win; the scheme and a leading "www." are optional for all of them.
+URL_PATTERNS = [
+    ('doi', r'(?:dx\.)?doi\.org/(?P<{}>10\..+)'),
+    ('doi', r'doi:(?P<{}>10\..+)'),
+    ('pmid', r'ncbi\.nlm\.nih\.gov/pubmed/(?:\?term=)?(?P<{}>\d+)(?:[/?#]|$)'),
+    ('pmid', r'pubmed\.ncbi\.nlm\.nih\.gov/(?P<{}>\d+)(?:[/?#]|$)'),
+    ('pmid', r'europepmc\.org/(?:abstract|article)/MED/(?P<{}>\d+)'),
+    ('pmcid', r'ncbi\.nlm\.nih\.gov/pmc/articles/PMC(?P<{}>\d+)'),
+    ('pmcid', r'europepmc\.org/(?:articles/|(?:abstract|article)/PMC/)'
+              r'PMC(?P<{}>\d+)')
+]
+
+URL_MATCHER = re.compile(
+    r'(?:https?://)?(?:www\.)?(?:' +
+    '|'.join('(?:' + pattern.format('m' + str(n)) + ')'
+             for n, (kind, pattern) in enumerate(URL_PATTERNS)) +
+    ')', re.IGNORECASE)
+
+# Publisher pages that carry a DOI in a /doi/ path segment, e.g.
+# https://onlinelibrary.wiley.com/doi/abs/10.1002/ajim.22000. Other paths
+# that merely contain something shaped like a DOI are left to Citoid.
+EMBEDDED_DOI = re.compile(r'/doi/(?:abs/|full/|fulltext/|pdf/|epdf/|'
+                          r'pdfdirect/)?(10\.\d{4,9}/[^?#&\s]+)',
+                          re.IGNORECASE)
+
+# Path parameters such as ";jsessionid=..." that servers tack onto a URL.
+# Semicolons inside DOIs (e.g. "...3.0.CO;2-X") have no "=" after them.
+PATH_PARAMETERS = re.compile(r';[A-Za-z_]+=.*$')
+
+DOI_TRAILERS = re.compile(r'(?:/(?:abstract|full|fulltext|pdf|epdf|meta))*'
+                          r'[/.,;]*$', re.IGNORECASE)
 
 
 def get_citoid(to_lookup):
@@ -13,25 +76,154 @@ def get_citoid(to_lookup):
 
     @param to_lookup: string URL to look up
     @return dictionary representing results
+    @raise rate_limit.CircuitOpen: if Citoid has been failing and is being
+    left alone for a while
     """
 
     url = "https://en.wikipedia.org/api/rest_v1/data/citation/mediawiki/"
     url += urllib.parse.quote_plus(to_lookup)
 
+    BREAKER.check()
+    LIMITER.acquire()
+
     try:
-        query = requests.get(url).json()
+        response = SESSION.get(url, timeout=CITOID_TIMEOUT)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise Exception(url)
+        query = response.json()
     except:
+        BREAKER.failure()
         raise Exception(url)
 
+    BREAKER.success()
+
     return query
 
 
-def convert(link):
+def set_rate_limit(rate):
+    """
+    @param rate: Citoid requests per second, across all threads
+    """
+
+    LIMITER.set_rate(rate)
+
+
+def count(stat):
+    with STATS_LOCK:
+        STATS[stat] += 1
+
+
+def cache_stats():
+    """
+    @return dictionary with the number of links resolved locally ('local'),
+    answered from the result cache ('hits'), and sent to Citoid ('misses'),
+    the number convert_many could not convert ('failed'), plus the cache hit
+    rate among hits and misses ('hit_rate')
+    """
+
+    with STATS_LOCK:
+        stats = dict(STATS)
+
+    looked_up = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / looked_up if looked_up > 0 else 0.0
+
+    return stats
+
+
+def print_cache_stats():
+    stats = cache_stats()
+
+    print('Links: {0} matched locally, {1} cached, {2} sent to Citoid '
+          '({3:.1%} cache hit rate), {4} failed'.format(
+              stats['local'], stats['hits'], stats['misses'],
+              stats['hit_rate'], stats['failed']))
+
+
+def get_cached(link):
+    """
+    @param link: string URL, as passed to convert
+    @return the cached convert result for the link, or None if there is none
+    """
+
+    raw = REDIS.get(CACHE_PREFIX + link)
+
+    if raw is None:
+        return None
+
+    try:
+        cached = json.loads(raw.decode('utf-8'))
+    except ValueError:
+        return None  # A bare "seen" marker from before results were cached
+
+    if not isinstance(cached, dict):
+        return None
+
+    return {x: cached.get(x) for x in ['doi', 'pmid', 'pmcid']}
+
+
+def set_cached(link, result):
+    """
+    Caches a convert result, with POSITIVE_TTL if it holds any identifier and
+    NEGATIVE_TTL otherwise.
+    """
+
+    if any(x is not None for x in result.values()):
+        ttl = POSITIVE_TTL
+    else:
+        ttl = NEGATIVE_TTL
+
+    REDIS.setex(CACHE_PREFIX + link, ttl, json.dumps(result))
+
+
+def clean_doi(doi):
+    """
+    @param doi: DOI as found in a link
+    @return the DOI upper-cased, without path parameters or trailing
+    page-type segments
+    """
+
+    doi = PATH_PARAMETERS.sub('', doi)
+
+    return DOI_TRAILERS.sub('', doi).upper()
+
+
+def match_link(link):
+    """
+    Reads a DOI, PMID, or PMCID straight out of a link, if it has one of the
+    shapes in URL_PATTERNS or embeds a DOI in its path. URL-encoded links
+    are decoded first.
+
+    @param link: string URL, without spaces
+    @return object with keys 'doi', 'pmid', and 'pmcid', or None if the link
+    is not recognized
+    """
+
+    link = urllib.parse.unquote(link)
+    found = {'doi': None, 'pmid': None, 'pmcid': None}
+
+    match = URL_MATCHER.match(link)
+    if match is not None:
+        kind = URL_PATTERNS[int(match.lastgroup[1:])][0]
+        found[kind] = match.group(match.lastgroup)
+        if kind == 'doi':
+            found[kind] = clean_doi(found[kind])
+        return found
+
+    match = EMBEDDED_DOI.search(link)
+    if match is not None:
+        found['doi'] = clean_doi(match.group(1))
+        return found
+
+    return None
+
+
+def convert(link, use_citoid=True):
     """
     Converts a URL into a DOI, PMID, or PMCID, using some URL interpreting
     strategies and using the Citoid service as a backup plan.
 
     @param link: string
+    @param use_citoid: if False, return None instead of asking Citoid
     @return object with keys 'doi', 'pmid', and 'pmcid'
     """
 
@@ -42,47 +234,71 @@ def convert(link):
     if link.endswith('.pdf'):
         return NO_RESULTS  # Don't bother
 
-    if REDIS.get('nioshtic__' + link) is not None:
-        return NO_RESULTS
+    found = match_link(link)
+    if found is not None:
+        count('local')
+        return found
+
+    cached = get_cached(link)
+    if cached is not None:
+        count('hits')
+        return cached
+
+    if use_citoid is False:
+        return None
+
+    count('misses')
 
     doi = None
     pmid = None
     pmcid = None
 
-    if link.startswith('http://dx.doi.org/'):
-        doi = link.replace('http://dx.doi.org/', '').upper()
-    elif link.startswith('http://doi.org/'):
-        doi = link.replace('http://doi.org/', '').upper()
-    elif link.startswith('https://dx.doi.org/'):
-        doi = link.replace('https://dx.doi.org/', '').upper()
-    elif link.startswith('https://doi.org/'):
-        doi = link.replace('https://doi.org/', '').upper()
-    elif link.startswith('https://www.ncbi.nlm.nih.gov/pubmed/?term='):
-        pmid = link.replace('https://www.ncbi.nlm.nih.gov/pubmed/?term=', '')
-    elif link.startswith('http://www.ncbi.nlm.nih.gov/pubmed/?term='):
-        pmid = link.replace('http://www.ncbi.nlm.nih.gov/pubmed/?term=', '')
-    elif link.startswith('https://www.ncbi.nlm.nih.gov/pmc/articles/PMC'):
-        pmcid = link.replace('https://www.ncbi.nlm.nih.gov/pmc/articles/PMC',
-                             '')
-        pmcid = pmcid.replace('/', '')
-    elif link.startswith('http://www.ncbi.nlm.nih.gov/pmc/articles/PMC'):
-        pmcid = link.replace('http://www.ncbi.nlm.nih.gov/pmc/articles/PMC',
-                             '')
-        pmcid = pmcid.replace('/', '')
-    else:
-        # Citoid is used as a last resort because it's super-slow.
-        citoid = get_citoid(link)
+    # Citoid is used as a last resort because it's super-slow.
+    citoid = get_citoid(link)
+
+    if len(citoid) == 1:
+        if 'DOI' in citoid:
+            doi = citoid['DOI'].upper()
 
-        if len(citoid) == 1:
-            if 'DOI' in citoid:
-                doi = citoid['DOI'].upper()
+        if 'PMID' in citoid:
+            pmid = citoid['PMID']
+
+        if 'PMCID' in citoid:
+            pmcid = citoid['PMCID'].replace('PMC', '')
+
+    result = {'doi': doi, 'pmid': pmid, 'pmcid': pmcid}
+    set_cached(link, result)
+
+    return result
+
+
+def convert_many(links, workers=default_workers, use_citoid=True):
+    """
+    Converts many URLs at once, from a pool of threads. Lookups that reach
+    Citoid stay within the shared rate limit.
+
+    A link whose lookup fails (a Citoid timeout or error, Citoid being left
+    alone while it is failing, or Redis trouble) is left out of the result
+    and nothing is cached for it, so callers can tell it apart from a link
+    with no identifiers and try it again later.
+
+    @param links: iterable of strings
+    @param workers: number of concurrent Citoid lookups
+    @param use_citoid: if False, only links that can be read locally or are
+    cached are converted; the others are left out of the result as well
+    @return dictionary {link: object with keys 'doi', 'pmid', and 'pmcid'}
+    """
 
-            if 'PMID' in citoid:
-                pmid = citoid['PMID']
+    def attempt(link):
+        try:
+            return convert(link, use_citoid)
+        except Exception:
+            count('failed')
+            return None
 
-            if 'PMCID' in citoid:
-                pmcid = citoid['PMCID'].replace('PMC', '')
+    links = list(dict.fromkeys(links))
 
-    REDIS.setex('nioshtic__' + link, timedelta(days=7), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(attempt, links)
 
-    return {'doi': doi, 'pmid': pmid, 'pmcid': pmcid}
+        return {x: y for x, y in zip(links, results) if y is not None}
@@ -1,27 +1,199 @@
-import redis
+import heapq
+import identifier_index
+import json
+import os
+import redis_pool
+import tempfile
+import threading
 from collections import OrderedDict
-from wikidata_credentials import *
 
-REDIS = redis.Redis(host=redis_server, port=redis_port, password=redis_key)
+REDIS = redis_pool.client
 
-def get_all_items(wd_prop, descending_order=True):
-    identifier_list = hgetall('wikidata_to_' + wd_prop)
-    identifier_list = [x + '|' + y for x, y in identifier_list.items()]
-    identifier_list.sort(reverse=descending_order)
+HMGET_BATCH = 10000
+HSCAN_COUNT = 10000
+SORT_CHUNK = 500000
+
+default_cache_size = 100000
+
+CACHE_MISS = object()
+
+# Bounded least-recently-used cache of hash lookups, keyed by
+# (keyname, itemname). Absent values are cached too, as None.
+class LRUCache:
+    def __init__(self, maxsize=default_cache_size):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return CACHE_MISS
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def invalidate(self, keyname=None, itemname=None):
+        with self.lock:
+            if keyname is None:
+                self.data.clear()
+            elif itemname is not None:
+                self.data.pop((keyname, itemname), None)
+            else:
+                for key in [x for x in self.data if x[0] == keyname]:
+                    del self.data[key]
+
+    def info(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.data), 'maxsize': self.maxsize}
+
+CACHE = LRUCache()
+
+def set_cache_size(maxsize):
+    with CACHE.lock:
+        CACHE.maxsize = maxsize
+        while len(CACHE.data) > max(maxsize, 0):
+            CACHE.data.popitem(last=False)
+
+def cache_info():
+    return CACHE.info()
+
+# Call after writing to a hash during a run, so stale lookups are not served
+# from the cache. Without itemname, forgets the whole hash; without keyname,
+# forgets everything.
+def invalidate(keyname=None, itemname=None):
+    CACHE.invalidate(keyname, itemname)
+
+# If a local identifier index has been built and holds the property, lookups
+# on the Redis hashes are answered from it instead. Returns (index, property,
+# keyed by Q-number?), or None to use Redis.
+def index_for(keyname):
+    index = identifier_index.get_default_index()
+
+    if index is None:
+        return None
+
+    if keyname.startswith('wikidata_to_'):
+        prop, by_qid = keyname[len('wikidata_to_'):], True
+    elif keyname.endswith('_to_wikidata'):
+        prop, by_qid = keyname[:-len('_to_wikidata')], False
+    else:
+        return None
+
+    if not index.has_property(prop):
+        return None
+
+    return index, prop, by_qid
+
+def qid_number(qid):
+    return int(qid[1:]) if qid[1:].isdigit() else 0
+
+# Streams the fields of a hash with HSCAN (or from the identifier index)
+# without loading it all at once. Yields decoded (field, value) tuples in no
+# particular order.
+def iter_items(keyname, count=HSCAN_COUNT):
+    local = index_for(keyname)
+
+    if local is not None:
+        index, prop, by_qid = local
+        for value, qid in index.items_with(prop):
+            yield (qid, value) if by_qid is True else (value, qid)
+        return
+
+    for x, y in REDIS.hscan_iter(keyname, count=count):
+        yield x.decode('utf-8'), y.decode('utf-8')
+
+# Writes a sorted run to a temporary file and returns it rewound.
+def spill(chunk, descending_order):
+    chunk.sort(key=lambda x: qid_number(x[0]), reverse=descending_order)
+    run = tempfile.TemporaryFile('w+', encoding='utf-8')
+    for pair in chunk:
+        run.write(json.dumps(pair) + '\n')
+    run.seek(0)
+    return run
+
+def read_run(run):
+    for line in run:
+        yield tuple(json.loads(line))
+
+# Yields (Q-number, identifier) tuples of a wikidata_to_<prop> hash ordered
+# numerically by Q-number. Only chunk_size pairs are held in memory at once;
+# larger hashes are sorted in runs on disk and merged.
+def iter_all_items(wd_prop, descending_order=True, chunk_size=SORT_CHUNK):
+    runs = []
+    chunk = []
+
+    try:
+        for pair in iter_items('wikidata_to_' + wd_prop):
+            chunk.append(pair)
+            if len(chunk) >= chunk_size:
+                runs.append(spill(chunk, descending_order))
+                chunk = []
+
+        if len(runs) == 0:
+            chunk.sort(key=lambda x: qid_number(x[0]),
+                       reverse=descending_order)
+            yield from chunk
+            return
+
+        runs.append(spill(chunk, descending_order))
+        chunk = []
+        yield from heapq.merge(*[read_run(x) for x in runs],
+                               key=lambda x: qid_number(x[0]),
+                               reverse=descending_order)
+    finally:
+        for run in runs:
+            run.close()
 
-    return OrderedDict({x.split('|')[0]: x.split('|')[1] for x in identifier_list})
+# Saves the ordered pairs as tab-separated lines, so later runs can stream
+# them back with iter_export instead of scanning Redis again.
+def export_all_items(wd_prop, filename, descending_order=True):
+    count = 0
+
+    with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+        for qid, value in iter_all_items(wd_prop, descending_order):
+            f.write(qid + '\t' + value + '\n')
+            count += 1
+    os.replace(filename + '.tmp', filename)
+
+    return count
+
+def iter_export(filename):
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            qid, value = line.rstrip('\n').split('\t', 1)
+            yield qid, value
+
+def get_all_items(wd_prop, descending_order=True):
+    return OrderedDict(iter_all_items(wd_prop, descending_order))
 
 def hgetall(keyname):
+    local = index_for(keyname)
+
+    if local is not None:
+        index, prop, by_qid = local
+        if by_qid is True:
+            return {qid: value for value, qid in index.items_with(prop)}
+        return dict(index.items_with(prop))
+
     raw = REDIS.hgetall(keyname)
     return {x.decode('utf-8'): y.decode('utf-8') for x, y in raw.items()}
 
 def hget(keyname, itemname):
-    raw = REDIS.hget(keyname, itemname)
-
-    if raw is None:
-        return None
-    else:
-        return raw.decode('utf-8')
+    return hmget(keyname, [itemname])[itemname]
 
 def doi_to_wikidata(doi):
     return hget('P356_to_wikidata', doi)
@@ -40,3 +212,109 @@ def wikidata_to_pmid(wikidata):
 
 def wikidata_to_pmcid(wikidata):
     return hget('wikidata_to_P932', wikidata)
+
+def decode(raw):
+    return None if raw is None else raw.decode('utf-8')
+
+# Reads {keyname: [itemnames]} from the identifier index, and whatever the
+# index does not have from Redis in a single pipelined round trip. An index
+# miss may just mean the index is out of date, so it is never the last word.
+# Returns {keyname: {itemname: value or None}}. Bypasses the cache.
+def fetch_many(wanted):
+    fetched = {}
+    remote = {}
+
+    for keyname, itemnames in wanted.items():
+        fetched[keyname] = {}
+        local = index_for(keyname)
+        if local is None:
+            remote[keyname] = list(itemnames)
+            continue
+
+        index, prop, by_qid = local
+        for itemname in itemnames:
+            if by_qid is True:
+                values = index.identifiers_of(itemname, prop).get(prop, [])
+                value = values[0] if len(values) > 0 else None
+            else:
+                value = index.lookup_one(prop, itemname)
+            if value is None:
+                remote.setdefault(keyname, []).append(itemname)
+            else:
+                fetched[keyname][itemname] = value
+
+    if len(remote) > 0:
+        pipe = REDIS.pipeline(transaction=False)
+        for keyname, itemnames in remote.items():
+            for x in range(0, len(itemnames), HMGET_BATCH):
+                pipe.hmget(keyname, itemnames[x:x + HMGET_BATCH])
+
+        results = iter(pipe.execute())
+        for keyname, itemnames in remote.items():
+            values = []
+            for x in range(0, len(itemnames), HMGET_BATCH):
+                values += next(results)
+            fetched[keyname].update(
+                {x: decode(y) for x, y in zip(itemnames, values)})
+
+    return fetched
+
+# Looks up many fields of several hashes at once, answering what it can from
+# the cache and fetching the rest in one round trip.
+def lookup_many(wanted):
+    found = {}
+    missing = {}
+
+    for keyname, itemnames in wanted.items():
+        found[keyname] = {}
+        for itemname in dict.fromkeys(itemnames):
+            value = CACHE.get((keyname, itemname))
+            if value is CACHE_MISS:
+                missing.setdefault(keyname, []).append(itemname)
+            else:
+                found[keyname][itemname] = value
+
+    if len(missing) > 0:
+        for keyname, values in fetch_many(missing).items():
+            for itemname, value in values.items():
+                CACHE.put((keyname, itemname), value)
+            found[keyname].update(values)
+
+    return found
+
+# Looks up many fields of one hash. Returns {itemname: value or None}.
+def hmget(keyname, itemnames):
+    return lookup_many({keyname: list(itemnames)})[keyname]
+
+def dois_to_wikidata(dois):
+    return hmget('P356_to_wikidata', dois)
+
+def pmids_to_wikidata(pmids):
+    return hmget('P698_to_wikidata', pmids)
+
+def pmcids_to_wikidata(pmcids):
+    return hmget('P932_to_wikidata', pmcids)
+
+def wikidata_to_dois(wikidata_ids):
+    return hmget('wikidata_to_P356', wikidata_ids)
+
+def wikidata_to_pmids(wikidata_ids):
+    return hmget('wikidata_to_P698', wikidata_ids)
+
+def wikidata_to_pmcids(wikidata_ids):
+    return hmget('wikidata_to_P932', wikidata_ids)
+
+# Resolves every DOI, PMID and PMCID in a list of URLtoIdentifier.convert
+# results to Wikidata items in one Redis round trip, so a caller can prefetch
+# a whole batch of entries before working through them.
+# Returns {'doi': {doi: qid or None}, 'pmid': {...}, 'pmcid': {...}}.
+def prefetch(ident_blocks):
+    keynames = {'doi': 'P356_to_wikidata',
+                'pmid': 'P698_to_wikidata',
+                'pmcid': 'P932_to_wikidata'}
+    wanted = {keynames[x]: [y[x] for y in ident_blocks if y.get(x) is not None]
+              for x in keynames}
+
+    found = lookup_many(wanted)
+
+    return {x: found[keynames[x]] for x in keynames}
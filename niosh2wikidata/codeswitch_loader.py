@@ -0,0 +1,183 @@
+#!/usr/local/bin/python3
+"""
+Fills the Redis hashes that codeswitch reads: P356_to_wikidata,
+P698_to_wikidata and P932_to_wikidata (DOI, PubMed ID and PMCID to Q-number)
+and their reverses wikidata_to_P356, wikidata_to_P698 and wikidata_to_P932.
+
+Pairs are read from saved Wikidata Query Service results or from the Wikidata
+JSON dump, the same inputs identifier_index accepts. A full load writes into
+scratch hashes and renames them over the live ones when done, so readers
+never see a half-built table and identifiers removed from Wikidata disappear.
+Only the hashes of properties that occur in the input are replaced.
+An incremental load (--incremental) compares against what is already in Redis
+and writes only pairs that are new or changed.
+
+Usage:
+    codeswitch_loader.py [--incremental] sparql results.json [more.json ...]
+    codeswitch_loader.py [--incremental] dump latest-all.json.gz
+"""
+
+import argparse
+import identifier_index
+import redis_pool
+import time
+
+PROPERTIES = ['P356', 'P698', 'P932']
+
+HSET_BATCH = 10000
+
+# Print progress every this many pairs.
+REPORT_EVERY = 500000
+
+SCRATCH_SUFFIX = '.loading'
+
+
+def hash_names(prop):
+    """
+    @return (identifier to Q-number hash, Q-number to identifier hash)
+    """
+
+    return prop + '_to_wikidata', 'wikidata_to_' + prop
+
+
+def changed_pairs(redis, batch):
+    """
+    Drops the pairs Redis already holds, with one pipelined round trip.
+
+    @param redis: redis.Redis client
+    @param batch: list of (prop, value, qid) tuples
+    @return list of the tuples that are new or different
+    """
+
+    pipe = redis.pipeline(transaction=False)
+    for prop, value, qid in batch:
+        forward, reverse = hash_names(prop)
+        pipe.hget(forward, value)
+        pipe.hget(reverse, qid)
+    results = pipe.execute()
+
+    changed = []
+    for n, (prop, value, qid) in enumerate(batch):
+        current_qid, current_value = results[2 * n], results[2 * n + 1]
+        if current_qid != qid.encode('utf-8') \
+        or current_value != value.encode('utf-8'):
+            changed.append((prop, value, qid))
+
+    return changed
+
+
+def write_batch(redis, batch, suffix=''):
+    """
+    Writes both directions of every pair with one pipelined HSET per hash.
+
+    @param redis: redis.Redis client
+    @param batch: list of (prop, value, qid) tuples
+    @param suffix: appended to the hash names, e.g. SCRATCH_SUFFIX
+    """
+
+    mappings = {}
+    for prop, value, qid in batch:
+        forward, reverse = hash_names(prop)
+        mappings.setdefault(forward + suffix, {})[value] = qid
+        mappings.setdefault(reverse + suffix, {})[qid] = value
+
+    pipe = redis.pipeline(transaction=False)
+    for keyname, mapping in mappings.items():
+        pipe.hset(keyname, mapping=mapping)
+    pipe.execute()
+
+
+def load(triples, incremental=False):
+    """
+    Loads identifier pairs into the codeswitch hashes.
+
+    @param triples: iterable of (prop, value, qid) tuples; properties other
+    than PROPERTIES are ignored
+    @param incremental: only write pairs that are missing or different,
+    instead of rebuilding the hashes from scratch
+    @return (pairs read, pairs written)
+    """
+
+    redis = redis_pool.get_redis()
+    suffix = '' if incremental is True else SCRATCH_SUFFIX
+
+    if incremental is False:
+        for prop in PROPERTIES:
+            redis.delete(*[x + suffix for x in hash_names(prop)])
+
+    read = 0
+    written = 0
+    seen = set()
+    batch = []
+    started = time.time()
+    next_report = REPORT_EVERY
+
+    def flush(batch):
+        if incremental is True:
+            batch = changed_pairs(redis, batch)
+        if len(batch) > 0:
+            write_batch(redis, batch, suffix)
+        return len(batch)
+
+    for prop, value, qid in triples:
+        if prop not in PROPERTIES:
+            continue
+
+        batch.append((prop, identifier_index.normalize(prop, value), qid))
+        seen.add(prop)
+        read += 1
+
+        if len(batch) >= HSET_BATCH:
+            written += flush(batch)
+            batch = []
+
+        if read >= next_report:
+            report(read, written, started)
+            next_report += REPORT_EVERY
+
+    written += flush(batch)
+
+    # Only the properties present in the input are replaced, so loading DOIs
+    # and PMIDs from separate files does not wipe one with the other.
+    if incremental is False:
+        for prop in seen:
+            for keyname in hash_names(prop):
+                redis.rename(keyname + suffix, keyname)
+
+    report(read, written, started)
+
+    return read, written
+
+
+def report(read, written, started):
+    elapsed = max(time.time() - started, 0.001)
+
+    print('{0} pairs read, {1} written in {2:.1f}s ({3:.0f} pairs/s)'.format(
+        read, written, elapsed, read / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fill the Redis identifier hashes used by codeswitch.')
+    parser.add_argument('source', choices=['sparql', 'dump'],
+                        help='kind of input file')
+    parser.add_argument('filenames', nargs='+',
+                        help='saved SPARQL JSON results, or one dump file')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only write pairs that are new or changed')
+    args = parser.parse_args()
+
+    if args.source == 'sparql':
+        def triples():
+            for filename in args.filenames:
+                yield from identifier_index.sparql_triples(filename)
+    else:
+        def triples():
+            for filename in args.filenames:
+                yield from identifier_index.dump_triples(filename)
+
+    load(triples(), args.incremental)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Matches articles to DOIs against a local Crossref metadata snapshot instead of
+the Crossref API.
+
+The snapshot is JSON Lines, one Crossref work record per line (as in the
+"message" of https://api.crossref.org/works/<DOI>), optionally gzipped. Works
+are grouped by (volume, issue), and within each group an inverted index from
+title trigrams to works narrows a lookup down to a handful of candidates
+before any Levenshtein distance is computed.
+"""
+
+import editdistance
+import gzip
+import json
+import re
+
+NON_ALPHANUMERIC = re.compile(r'[^0-9A-Z]+')
+
+# Candidates per lookup that get a full edit-distance check, best trigram
+# overlap first.
+CANDIDATES = 5
+
+# Titles must differ by fewer than this many edits, as with the API matcher.
+MAX_DISTANCE = 10
+
+
+def normalize_title(title):
+    """
+    @return the title upper-cased, with runs of anything but letters and
+    digits collapsed to single spaces
+    """
+
+    return NON_ALPHANUMERIC.sub(' ', title.upper()).strip()
+
+
+def trigrams(title):
+    """
+    @param title: normalized title
+    @return set of character trigrams
+    """
+
+    padded = ' ' + title + ' '
+
+    return {padded[x:x + 3] for x in range(len(padded) - 2)}
+
+
+def open_snapshot(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8')
+
+    return open(filename, encoding='utf-8')
+
+
+class Partition:
+    def __init__(self):
+        """
+        Constructor of the Partition class: the works of one (volume, issue)
+        and their trigram index.
+        """
+        self.works = []  # (upper-cased title, DOI, trigram count)
+        self.postings = {}
+
+    def add(self, title, doi):
+        grams = trigrams(normalize_title(title))
+        position = len(self.works)
+
+        self.works.append((title.upper(), doi.upper(), len(grams)))
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(position)
+
+    def candidates(self, title, limit=CANDIDATES):
+        """
+        @param title: title to look for
+        @return positions of the works sharing the most trigrams with it,
+        ranked by Jaccard similarity
+        """
+
+        grams = trigrams(normalize_title(title))
+        shared = {}
+
+        for gram in grams:
+            for position in self.postings.get(gram, []):
+                shared[position] = shared.get(position, 0) + 1
+
+        def similarity(position):
+            overlap = shared[position]
+            return overlap / (len(grams) + self.works[position][2] - overlap)
+
+        return sorted(shared, key=similarity, reverse=True)[:limit]
+
+    def match(self, title, max_distance=MAX_DISTANCE):
+        """
+        @return DOI of the closest work within max_distance edits, or None
+        """
+
+        title = title.upper()
+        best = None
+
+        for position in self.candidates(title):
+            work_title, doi, _ = self.works[position]
+            distance = editdistance.eval(title, work_title)
+            if distance < max_distance \
+            and (best is None or distance < best[0]):
+                best = (distance, doi)
+
+        return None if best is None else best[1]
+
+
+class Snapshot:
+    def __init__(self):
+        """
+        Constructor of the Snapshot class. Call load() to fill it.
+        """
+        self.partitions = {}
+        self.count = 0
+
+    def load(self, filename, wanted=None):
+        """
+        Indexes the works of a snapshot file.
+
+        @param filename: path to a .jsonl or .jsonl.gz snapshot
+        @param wanted: if given, a set of (volume, issue) tuples; works in
+        other issues are skipped, which keeps memory to what a seed needs
+        @return number of works indexed
+        """
+
+        count = 0
+
+        with open_snapshot(filename) as f:
+            for line in f:
+                if line.strip() == '':
+                    continue
+                work = json.loads(line)
+                if 'DOI' not in work or len(work.get('title', [])) == 0 \
+                or 'volume' not in work or 'issue' not in work:
+                    continue
+
+                key = (work['volume'], work['issue'])
+                if wanted is not None and key not in wanted:
+                    continue
+
+                self.partitions.setdefault(key, Partition()).add(
+                    work['title'][0], work['DOI'])
+                count += 1
+
+        self.count += count
+
+        return count
+
+    def match(self, title, volume, issue):
+        """
+        Finds the DOI of an article by its title, volume, and issue.
+
+        @return DOI string, upper-cased, or None
+        """
+
+        partition = self.partitions.get((volume, issue))
+
+        if partition is None:
+            return None
+
+        return partition.match(title)
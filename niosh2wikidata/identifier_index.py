@@ -0,0 +1,384 @@
+#!/usr/local/bin/python3
+"""
+A local, offline index of the Wikidata identifiers this library cares about
+(DOI, PubMed ID, PMCID, ISBN-10, ISBN-13, CAS number, NIOSHTIC ID), mapping
+them to Q-numbers and back.
+
+The index is a SQLite file, bulk-loaded from saved Wikidata Query Service
+results or from an extract of the Wikidata JSON dump. Once built, lookups are
+answered from its B-tree indexes with no network or Redis round trips.
+
+Usage:
+    identifier_index.py load-sparql results.json [more.json ...]
+    identifier_index.py load-dump latest-all.json.gz
+    identifier_index.py lookup P356 10.1000/XYZ
+"""
+
+import bz2
+import gzip
+import json
+import os
+import sqlite3
+import sys
+
+DEFAULT_PATH = 'cache/identifiers.sqlite3'
+
+ENTITY_PREFIX = 'http://www.wikidata.org/entity/'
+
+# Wikidata property for each identifier, and the SPARQL variable names that
+# are recognized as holding it.
+PROPERTIES = {
+    'P356': ['doi'],
+    'P698': ['pmid', 'pubmed'],
+    'P932': ['pmcid'],
+    'P957': ['isbn10'],
+    'P212': ['isbn13'],
+    'P231': ['cas'],
+    'P2880': ['nioshtic', 'n']
+}
+
+VARIABLES = {alias: prop for prop, aliases in PROPERTIES.items()
+             for alias in aliases + [prop.lower()]}
+
+BATCH_SIZE = 50000
+
+
+def normalize(prop, value):
+    """
+    Brings an identifier into the form it is stored and looked up in: DOIs
+    upper-cased as on Wikidata, ISBNs without hyphens, PMCIDs without the
+    'PMC' prefix.
+
+    @param prop: Wikidata property, e.g. 'P356'
+    @param value: identifier string
+    @return normalized string
+    """
+
+    value = value.strip()
+
+    if prop == 'P356':
+        return value.upper()
+    if prop in ('P957', 'P212'):
+        return value.replace('-', '').replace(' ', '')
+    if prop == 'P932' and value.upper().startswith('PMC'):
+        return value[3:]
+
+    return value
+
+
+def open_dump(filename):
+    """
+    Opens a Wikidata JSON dump, plain or compressed, for reading as text.
+    """
+
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8')
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, 'rt', encoding='utf-8')
+
+    return open(filename, encoding='utf-8')
+
+
+def sparql_triples(filename):
+    """
+    Reads identifiers from a saved Wikidata Query Service JSON result. The
+    item variable is whichever binding holds an entity URI; the other
+    variables are matched to properties by name (see PROPERTIES), e.g. ?doi
+    or ?p356.
+
+    @param filename: path to the JSON result file
+    @return generator of (prop, value, qid) tuples
+    """
+
+    with open(filename, encoding='utf-8') as f:
+        bindings = json.load(f)['results']['bindings']
+
+    for binding in bindings:
+        qid = None
+        for variable, cell in binding.items():
+            if cell['type'] == 'uri' \
+            and cell['value'].startswith(ENTITY_PREFIX + 'Q'):
+                qid = cell['value'].replace(ENTITY_PREFIX, '')
+                break
+        if qid is None:
+            continue
+        for variable, cell in binding.items():
+            prop = VARIABLES.get(variable.lower())
+            if prop is not None and cell['type'] == 'literal':
+                yield (prop, cell['value'], qid)
+
+
+def dump_triples(filename):
+    """
+    Reads identifiers from the Wikidata JSON dump, or any extract of it that
+    keeps one entity per line.
+
+    @param filename: path to a .json, .json.gz, or .json.bz2 file
+    @return generator of (prop, value, qid) tuples
+    """
+
+    with open_dump(filename) as f:
+        for line in f:
+            line = line.strip().rstrip(',')
+            if line in ('', '[', ']'):
+                continue
+            entity = json.loads(line)
+            claims = entity.get('claims', {})
+            for prop in PROPERTIES:
+                for claim in claims.get(prop, []):
+                    snak = claim['mainsnak']
+                    if snak.get('snaktype') == 'value':
+                        yield (prop, snak['datavalue']['value'], entity['id'])
+
+
+class IdentifierIndex:
+    def __init__(self, path=DEFAULT_PATH):
+        """
+        Constructor of the IdentifierIndex class. Creates the database file
+        and its tables if they do not exist yet.
+
+        @param path: location of the SQLite file
+        """
+        directory = os.path.dirname(path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.known = {}  # prop -> whether the index holds any of it
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('create table if not exists identifiers ('
+                        'prop text not null, '
+                        'value text not null, '
+                        'qid text not null, '
+                        'primary key (prop, value, qid)) without rowid')
+        self.db.execute('create index if not exists identifiers_by_qid '
+                        'on identifiers (qid, prop)')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def add_many(self, triples):
+        """
+        Bulk-inserts identifiers.
+
+        @param triples: iterable of (prop, value, qid) tuples
+        @return number of tuples processed
+        """
+
+        count = 0
+        batch = []
+
+        for prop, value, qid in triples:
+            batch.append((prop, normalize(prop, value), qid))
+            if len(batch) >= BATCH_SIZE:
+                self.db.executemany('insert or ignore into identifiers '
+                                    'values (?, ?, ?)', batch)
+                count += len(batch)
+                batch = []
+
+        self.db.executemany('insert or ignore into identifiers '
+                            'values (?, ?, ?)', batch)
+        count += len(batch)
+        self.db.commit()
+        self.known = {}
+
+        return count
+
+    def add(self, prop, value, qid):
+        """
+        Records a single identifier, e.g. for an item created during a run.
+        """
+
+        self.add_many([(prop, value, qid)])
+
+    def has_property(self, prop):
+        """
+        Does the index hold any identifiers of this property at all? An index
+        built for one purpose, e.g. only the NIOSHTIC IDs for Associator,
+        should not be taken as knowing every DOI.
+
+        @param prop: Wikidata property, e.g. 'P356'
+        @return bool
+        """
+
+        if prop not in self.known:
+            row = self.db.execute('select 1 from identifiers where prop = ? '
+                                  'limit 1', (prop,)).fetchone()
+            self.known[prop] = row is not None
+
+        return self.known[prop]
+
+    def lookup(self, prop, value):
+        """
+        Finds the items that have a given identifier.
+
+        @param prop: Wikidata property, e.g. 'P356'
+        @param value: identifier string
+        @return list of Q-numbers, possibly empty
+        """
+
+        rows = self.db.execute('select qid from identifiers '
+                               'where prop = ? and value = ?',
+                               (prop, normalize(prop, value)))
+
+        return [x[0] for x in rows]
+
+    def lookup_one(self, prop, value):
+        """
+        @return the first Q-number with the identifier, or None
+        """
+
+        found = self.lookup(prop, value)
+
+        return found[0] if len(found) > 0 else None
+
+    def identifiers_of(self, qid, prop=None):
+        """
+        Finds the identifiers an item has.
+
+        @param qid: Q-number
+        @param prop: only this property if given
+        @return dictionary {prop: [values]}
+        """
+
+        if prop is None:
+            rows = self.db.execute('select prop, value from identifiers '
+                                   'where qid = ?', (qid,))
+        else:
+            rows = self.db.execute('select prop, value from identifiers '
+                                   'where qid = ? and prop = ?', (qid, prop))
+
+        found = {}
+        for row_prop, value in rows:
+            found.setdefault(row_prop, []).append(value)
+
+        return found
+
+    def items_with(self, prop):
+        """
+        Iterates over every item that has a given property.
+
+        @param prop: Wikidata property, e.g. 'P2880'
+        @return generator of (value, qid) tuples
+        """
+
+        rows = self.db.execute('select value, qid from identifiers '
+                               'where prop = ?', (prop,))
+
+        for row in rows:
+            yield row
+
+    def load_sparql_results(self, filename):
+        """
+        Loads a saved Wikidata Query Service JSON result (see sparql_triples).
+
+        @param filename: path to the JSON result file
+        @return number of identifiers loaded
+        """
+
+        return self.add_many(sparql_triples(filename))
+
+    def load_dump(self, filename):
+        """
+        Loads identifiers from the Wikidata JSON dump (see dump_triples).
+
+        @param filename: path to a .json, .json.gz, or .json.bz2 file
+        @return number of identifiers loaded
+        """
+
+        return self.add_many(dump_triples(filename))
+
+
+class IndexMap:
+    def __init__(self, index, props):
+        """
+        Constructor of the IndexMap class, a dictionary-like view from
+        identifier values to Q-numbers, for code written against in-memory
+        mappings.
+
+        @param index: an IdentifierIndex
+        @param props: list of properties to look in, first match wins; new
+        values are recorded under the first one, except that ISBNs go under
+        P957 or P212 by their length
+        """
+        self.index = index
+        self.props = props
+
+    def prop_for(self, value):
+        """
+        @return the property a new value should be recorded under
+        """
+
+        if 'P957' in self.props and 'P212' in self.props:
+            if len(normalize('P957', value)) == 10:
+                return 'P957'
+            return 'P212'
+
+        return self.props[0]
+
+    def get(self, value, default=None):
+        for prop in self.props:
+            qid = self.index.lookup_one(prop, value)
+            if qid is not None:
+                return qid
+
+        return default
+
+    def __contains__(self, value):
+        return self.get(value) is not None
+
+    def __getitem__(self, value):
+        qid = self.get(value)
+
+        if qid is None:
+            raise KeyError(value)
+
+        return qid
+
+    def __setitem__(self, value, qid):
+        self.index.add(self.prop_for(value), value, qid)
+
+
+_default_index = None
+
+
+def get_default_index():
+    """
+    Opens the index at DEFAULT_PATH once per process, if it has been built.
+
+    @return IdentifierIndex, or None if there is no index file
+    """
+
+    global _default_index
+
+    if _default_index is None and os.path.exists(DEFAULT_PATH):
+        _default_index = IdentifierIndex(DEFAULT_PATH)
+
+    return _default_index
+
+
+def main(args):
+    if len(args) < 2:
+        print(__doc__)
+        return
+
+    index = IdentifierIndex()
+
+    if args[0] == 'load-sparql':
+        for filename in args[1:]:
+            print(filename + ': ' + str(index.load_sparql_results(filename)) +
+                  ' identifiers')
+    elif args[0] == 'load-dump':
+        print(args[1] + ': ' + str(index.load_dump(args[1])) + ' identifiers')
+    elif args[0] == 'lookup' and len(args) == 3:
+        for qid in index.lookup(args[1], args[2]):
+            print(qid)
+    else:
+        print(__doc__)
+
+    index.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,101 @@
+"""
+Thread-safe helpers for being polite to remote services: a token bucket that
+spaces out requests, and a circuit breaker that stops sending them while a
+service keeps failing.
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        """
+        Constructor of the TokenBucket class.
+
+        @param rate: requests allowed per second, on average
+        @param burst: requests allowed back to back after an idle spell
+        """
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate, burst=None):
+        """
+        Changes the budget, e.g. after a service announces its limits.
+        """
+
+        with self.lock:
+            self.rate = rate
+            if burst is not None:
+                self.burst = burst
+                self.tokens = min(self.tokens, burst)
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=5, cooldown=60):
+        """
+        Constructor of the CircuitBreaker class. After `threshold` failures
+        in a row the circuit opens and check() fails immediately; after
+        `cooldown` seconds a single trial request is let through, and its
+        outcome closes or reopens the circuit.
+
+        @param threshold: consecutive failures that open the circuit
+        @param cooldown: seconds to wait before trying again
+        """
+        self.lock = threading.Lock()
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+
+    def check(self):
+        """
+        @raise CircuitOpen: if requests should not be sent right now
+        """
+
+        with self.lock:
+            if self.opened is None:
+                return
+            if time.monotonic() - self.opened < self.cooldown:
+                raise CircuitOpen()
+            # Let this one request through as a trial; others keep failing
+            # fast until it reports back.
+            self.opened = time.monotonic()
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.monotonic()
@@ -0,0 +1,116 @@
+"""
+Keeps track of the files Downloader saves in raw/: the date range each one
+covers, how many records it held, a hash of its content, and which pipeline
+stages have already processed that exact content. Stages use this to skip
+files that have not changed since they last saw them.
+"""
+
+import json
+import os
+
+# Deliberately not ending in .json, .jsonl or .txt, so the stages that
+# autodiscover files in raw/ never mistake the manifest for data.
+MANIFEST_FILE = 'raw/.manifest'
+
+# Pipeline stages in the order they run. A stage that rewrites a file
+# invalidates what the stages after it recorded for that file.
+STAGES = ['Cleaner', 'Associator', 'CreateJournalArticles',
+          'CreateFromNioshtic', 'FillFromNioshtic']
+
+
+def load_manifest():
+    """
+    Loads the record of completed downloads from raw/.manifest.
+
+    @return dictionary {filename: {'start': ..., 'end': ..., 'records': ...}}
+    """
+
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+
+    with open(MANIFEST_FILE) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest):
+    """
+    Atomically writes the manifest back to disk.
+
+    @param manifest: dictionary as returned by load_manifest
+    """
+
+    tmp_filename = MANIFEST_FILE + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp_filename, MANIFEST_FILE)
+
+
+def find_entry(manifest, filename):
+    """
+    Finds the manifest entry for a raw export or for any file derived from
+    it (e.g. raw/2017-01_to_2017-12.txt.jsonl).
+
+    @param manifest: dictionary as returned by load_manifest
+    @param filename: path of a raw or derived file
+    @return manifest entry dictionary, or None if the file is not tracked
+    """
+
+    for suffix in ['.jsonl', '.json']:
+        if filename.lower().endswith(suffix):
+            filename = filename[:-len(suffix)]
+            break
+
+    for candidate in [filename, filename + '.gz']:
+        if candidate in manifest:
+            return manifest[candidate]
+
+    return None
+
+
+def is_processed(manifest, filename, stage):
+    """
+    Has `stage` already processed the current content of this file? A file
+    that no longer exists has not been processed.
+
+    @param manifest: dictionary as returned by load_manifest
+    @param filename: path of the file the stage reads
+    @param stage: name of the pipeline stage, e.g. 'Associator'
+    @return bool
+    """
+
+    if not os.path.exists(filename):
+        return False
+
+    entry = find_entry(manifest, filename)
+
+    if entry is None or 'sha256' not in entry:
+        return False
+
+    return entry.get('processed', {}).get(stage) == entry['sha256']
+
+
+def mark_processed(manifest, filename, stage, rewrote=False):
+    """
+    Records that `stage` has processed the current content of this file, and
+    saves the manifest. Untracked files are ignored.
+
+    @param manifest: dictionary as returned by load_manifest
+    @param filename: path of a raw or derived file
+    @param stage: name of the pipeline stage, e.g. 'Associator'
+    @param rewrote: the stage (re)wrote the derived file, so the markers of
+    every later stage in STAGES no longer apply and are dropped
+    """
+
+    entry = find_entry(manifest, filename)
+
+    if entry is None or 'sha256' not in entry:
+        return
+
+    processed = entry.setdefault('processed', {})
+
+    if rewrote is True and stage in STAGES:
+        for later in STAGES[STAGES.index(stage) + 1:]:
+            processed.pop(later, None)
+
+    processed[stage] = entry['sha256']
+    save_manifest(manifest)
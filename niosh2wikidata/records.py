@@ -0,0 +1,327 @@
+"""
+Reading, writing, and compact in-memory representation of cleaned NIOSHTIC
+entries.
+
+A file of cleaned entries holds hundreds of thousands of records that all use
+the same couple dozen field names. Instead of a dictionary per record, a
+CompactEntry keeps a plain list of values and shares one Schema (field name to
+position) with every other entry from the same file.
+"""
+
+import json
+import os
+import shutil
+import sys
+
+_MISSING = object()
+
+
+class Schema:
+    def __init__(self, fields=()):
+        """
+        Constructor of the Schema class: an ordered set of field names, each
+        mapped to its position in a CompactEntry's value list.
+
+        @param fields: iterable of field names to register up front
+        """
+        self.positions = {}
+        self.fields = []
+
+        for field in fields:
+            self.position(field)
+
+    def position(self, field):
+        """
+        Looks up the position of a field, registering it if it is new.
+
+        @param field: string field name, e.g. 'NN'
+        @return integer
+        """
+
+        if field not in self.positions:
+            field = sys.intern(field)
+            self.positions[field] = len(self.fields)
+            self.fields.append(field)
+
+        return self.positions[field]
+
+
+class CompactEntry:
+    """
+    A NIOSHTIC entry that behaves like a read/write dictionary but stores only
+    a list of values.
+    """
+
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, pairs=()):
+        """
+        Constructor of the CompactEntry class.
+
+        @param schema: the Schema shared by entries from the same file
+        @param pairs: iterable of (field, value) tuples
+        """
+        self.schema = schema
+        self.values = []
+
+        for field, value in pairs:
+            self[field] = value
+
+    def __getitem__(self, field):
+        value = self.get(field, _MISSING)
+
+        if value is _MISSING:
+            raise KeyError(field)
+
+        return value
+
+    def __setitem__(self, field, value):
+        position = self.schema.position(field)
+
+        if position >= len(self.values):
+            self.values.extend([_MISSING] * (position + 1 - len(self.values)))
+
+        self.values[position] = value
+
+    def __delitem__(self, field):
+        self[field]  # raises KeyError if absent
+        self.values[self.schema.positions[field]] = _MISSING
+
+    def __contains__(self, field):
+        return self.get(field, _MISSING) is not _MISSING
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return sum(1 for x in self.values if x is not _MISSING)
+
+    def __eq__(self, other):
+        if isinstance(other, (CompactEntry, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return 'CompactEntry(' + repr(self.to_dict()) + ')'
+
+    def get(self, field, default=None):
+        position = self.schema.positions.get(field)
+
+        if position is None or position >= len(self.values):
+            return default
+
+        value = self.values[position]
+
+        return default if value is _MISSING else value
+
+    def items(self):
+        fields = self.schema.fields
+        return [(fields[n], x) for n, x in enumerate(self.values)
+                if x is not _MISSING]
+
+    def keys(self):
+        return [x[0] for x in self.items()]
+
+    def to_dict(self):
+        """
+        @return a plain dictionary copy of the entry
+        """
+
+        return dict(self.items())
+
+
+def to_json(obj):
+    """
+    `default` hook for json.dump, so CompactEntry objects serialize like the
+    dictionaries they stand in for.
+    """
+
+    if isinstance(obj, CompactEntry):
+        return obj.to_dict()
+
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+
+def load(f, compact=True):
+    """
+    Loads a whole single-document JSON file of cleaned entries. Prefer Reader,
+    which also understands the JSON Lines format and does not hold every
+    entry at once.
+
+    @param f: open file object
+    @param compact: build CompactEntry objects for the entries instead of
+    dictionaries
+    @return dictionary with "headers", "entries", and "retrieved" keys
+    """
+
+    if compact is False:
+        return json.load(f)
+
+    schema = Schema()
+
+    def object_pairs_hook(pairs):
+        keys = [x[0] for x in pairs]
+        if 'entries' in keys and 'headers' in keys:
+            return dict(pairs)
+        return CompactEntry(schema, pairs)
+
+    return json.load(f, object_pairs_hook=object_pairs_hook)
+
+
+def dump(nioshtic_data, f):
+    """
+    Writes cleaned NIOSHTIC data, with either kind of entry, as a single JSON
+    document. Prefer Writer for anything large.
+
+    @param nioshtic_data: dictionary with "headers", "entries", and
+    "retrieved" keys
+    @param f: open file object
+    """
+
+    json.dump(nioshtic_data, f, indent=4, default=to_json)
+
+
+def is_entries_file(filename):
+    """
+    Is this a file of cleaned entries, in either the JSON Lines format or the
+    older single-document JSON format?
+
+    @return bool
+    """
+
+    return filename.lower().endswith(('.jsonl', '.json'))
+
+
+class Reader:
+    def __init__(self, filename, compact=True):
+        """
+        Constructor of the Reader class, which iterates over the entries of a
+        file of cleaned entries one at a time.
+
+        The JSON Lines format starts with a header record holding "headers"
+        and "retrieved", followed by one entry per line. Files in the older
+        single-document format are still accepted, but are loaded whole.
+
+        @param filename: path to a .jsonl or .json file
+        @param compact: yield CompactEntry objects instead of dictionaries
+        """
+        self.filename = filename
+        self.compact = compact
+        self.schema = Schema()
+        self.file = open(filename)
+        self.legacy_entries = None
+
+        first_line = self.file.readline()
+
+        try:
+            header = json.loads(first_line)
+        except ValueError:
+            header = None
+
+        if not isinstance(header, dict) or 'entries' in header:
+            self.file.seek(0)
+            legacy = load(self.file, compact)
+            self.file.close()
+            header = legacy
+            self.legacy_entries = legacy['entries']
+
+        self.headers = list(header['headers'])
+        self.retrieved = header['retrieved']
+
+    def __iter__(self):
+        if self.legacy_entries is not None:
+            yield from self.legacy_entries
+            return
+
+        if self.compact is True:
+            hook = lambda pairs: CompactEntry(self.schema, pairs)
+        else:
+            hook = None
+
+        for line in self.file:
+            if line.strip() == '':
+                continue
+            yield json.loads(line, object_pairs_hook=hook)
+
+    def data(self):
+        """
+        @return dictionary with "headers", "retrieved", and "entries" keys, in
+        which "entries" is a one-time iterator rather than a list
+        """
+
+        return {
+            'headers': self.headers,
+            'retrieved': self.retrieved,
+            'entries': iter(self)
+        }
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Writer:
+    def __init__(self, filename, retrieved, headers=()):
+        """
+        Constructor of the Writer class, which writes a file of cleaned
+        entries in the JSON Lines format one entry at a time.
+
+        Entries are spooled to a temporary file while the header list is
+        collected; on close the header record and the entries are written
+        under a second temporary name that then replaces `filename`. An
+        interrupted write never leaves a partial file behind, and `filename`
+        may be the file currently being read.
+
+        @param filename: destination path, usually ending in .jsonl
+        @param retrieved: Wikidata-style date string of the download
+        @param headers: field names known up front, in order
+        """
+        self.filename = filename
+        self.retrieved = retrieved
+        self.headers = dict.fromkeys(headers)  # ordered set
+        self.count = 0
+        self.body = open(filename + '.body.tmp', 'w+')
+
+    def write(self, entry):
+        """
+        @param entry: dictionary or CompactEntry
+        """
+
+        for field in entry:
+            if field not in self.headers:
+                self.headers[field] = None
+
+        self.body.write(json.dumps(entry, default=to_json))
+        self.body.write('\n')
+        self.count += 1
+
+    def close(self):
+        header = {'headers': list(self.headers), 'retrieved': self.retrieved}
+
+        self.body.seek(0)
+        with open(self.filename + '.tmp', 'w') as f:
+            f.write(json.dumps(header))
+            f.write('\n')
+            shutil.copyfileobj(self.body, f)
+        self.body.close()
+
+        os.remove(self.filename + '.body.tmp')
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def abort(self):
+        self.body.close()
+        os.remove(self.filename + '.body.tmp')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
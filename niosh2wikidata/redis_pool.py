@@ -0,0 +1,120 @@
+"""
+One Redis connection pool shared by every module in this package.
+
+Nothing connects at import time: the pool is created on first use, from the
+redis_* settings in wikidata_credentials.py (see wikidata_credentials.py.sample)
+or from configure(). Connections are checked out per command and returned
+afterwards, so threads share the pool instead of each opening their own.
+"""
+
+import threading
+import redis
+
+default_host = '127.0.0.1'
+default_port = 6379
+default_max_connections = 50
+default_socket_timeout = 10
+default_connect_timeout = 5
+default_health_check_interval = 30
+
+# Seconds a thread waits for a free connection when all of them are in use.
+default_pool_timeout = 20
+
+_settings = {}
+_client = None
+_lock = threading.Lock()
+
+
+def settings():
+    """
+    Collects connection settings: values passed to configure() first, then
+    wikidata_credentials.py, then the defaults above.
+
+    @return dictionary of setting name to value
+    """
+
+    try:
+        import wikidata_credentials as credentials
+    except ImportError:
+        credentials = None
+
+    defaults = {
+        'host': ('redis_server', default_host),
+        'port': ('redis_port', default_port),
+        'password': ('redis_key', None),
+        'max_connections': ('redis_max_connections', default_max_connections),
+        'socket_timeout': ('redis_socket_timeout', default_socket_timeout),
+        'connect_timeout': ('redis_connect_timeout', default_connect_timeout),
+        'health_check_interval': ('redis_health_check_interval',
+                                  default_health_check_interval),
+        'pool_timeout': ('redis_pool_timeout', default_pool_timeout)
+    }
+
+    found = {}
+    for name, (credential, default) in defaults.items():
+        found[name] = getattr(credentials, credential, default)
+    found.update(_settings)
+
+    return found
+
+
+def configure(**overrides):
+    """
+    Overrides connection settings, e.g. configure(max_connections=100). Takes
+    effect the next time the pool is created, so call it before first use or
+    follow it with reset().
+    """
+
+    _settings.update(overrides)
+
+
+def get_redis():
+    """
+    @return the shared redis.Redis client, creating its pool on first call
+    """
+
+    global _client
+
+    if _client is None:
+        with _lock:
+            if _client is None:
+                config = settings()
+                pool = redis.BlockingConnectionPool(
+                    host=config['host'],
+                    port=config['port'],
+                    password=config['password'],
+                    max_connections=config['max_connections'],
+                    timeout=config['pool_timeout'],
+                    socket_timeout=config['socket_timeout'],
+                    socket_connect_timeout=config['connect_timeout'],
+                    health_check_interval=config['health_check_interval'])
+                _client = redis.Redis(connection_pool=pool)
+
+    return _client
+
+
+def reset():
+    """
+    Closes the pool's connections; the next use creates a new pool.
+    """
+
+    global _client
+
+    with _lock:
+        if _client is not None:
+            _client.connection_pool.disconnect()
+        _client = None
+
+
+class LazyRedis:
+    """
+    Stands in for a redis.Redis client and forwards everything to the shared
+    one, so modules can keep a module-level REDIS without connecting on
+    import.
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_redis(), name)
+
+
+client = LazyRedis()